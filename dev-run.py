@@ -1,26 +1,40 @@
+import argparse
 import os
 import subprocess
 
-user = os.getenv("USER")
+_BASE_ARGS = (
+    "flatpak",
+    "build",
+    "--with-appdir",
+    "--allow=devel",
+    "--die-with-parent",
+    "--nofilesystem=host",
+    "--env=PATH=/app/bin:/usr/bin",
+    "--talk-name=org.freedesktop.portal.*",
+    "--filesystem=~/.local:ro",
+    "--bind-mount=/run/host/local-fonts=/usr/local/share/fonts",
+    "--bind-mount=/run/host/fonts=/usr/share/fonts",
+)
+
+_A11Y_ARGS = (
+    "--talk-name=org.a11y.Bus",
+    "--env=AT_SPI_BUS_ADDRESS=unix:path=/run/flatpak/at-spi-bus",
+)
 
-subprocess.run(
-    [
-        "flatpak",
-        "build",
-        "--with-appdir",
-        "--allow=devel",
-        "--die-with-parent",
-        "--nofilesystem=host",
-        "--env=PATH=/app/bin:/usr/bin",
-        "--talk-name=org.freedesktop.portal.*",
-        "--filesystem=~/.local:ro",
-        f"--bind-mount=/run/host/font-dirs.xml=/home/{user}/.cache/font-dirs.xml",
-        "--bind-mount=/run/host/local-fonts=/usr/local/share/fonts",
-        "--bind-mount=/run/host/fonts=/usr/share/fonts",
-        "--talk-name=org.a11y.Bus",
-        "--bind-mount=/run/flatpak/at-spi-bus=/run/user/1000/at-spi/bus",
-        "--env=AT_SPI_BUS_ADDRESS=unix:path=/run/flatpak/at-spi-bus",
-        "build-dir",
-        "pyrose",
-    ]
+parser = argparse.ArgumentParser(description="Run PyRose from the build directory.")
+parser.add_argument(
+    "--a11y", action="store_true", help="give the app access to the a11y bus"
 )
+options = parser.parse_args()
+
+user = os.getenv("USER")
+args = list(_BASE_ARGS)
+args.append(f"--bind-mount=/run/host/font-dirs.xml=/home/{user}/.cache/font-dirs.xml")
+if options.a11y:
+    args.extend(_A11Y_ARGS)
+    args.append(
+        f"--bind-mount=/run/flatpak/at-spi-bus=/run/user/{os.getuid()}/at-spi/bus"
+    )
+args.extend(("build-dir", "pyrose"))
+
+subprocess.run(args)
@@ -1,5 +1,7 @@
 import asyncio
+import logging
 import os
+import re
 import gi
 
 from asyncio import Task
@@ -7,7 +9,10 @@ from lsp_types import (
     DiagnosticSeverity,
     DiagnosticTag,
     DocumentHighlight,
+    Position,
+    PositionEncodingKind,
     PublishDiagnosticsParams,
+    TextDocumentContentChangeEvent,
 )
 from .symbol_chooser import SymbolChooser
 
@@ -15,7 +20,13 @@ gi.require_version("Adw", "1")
 gi.require_version("Gdk", "4.0")
 gi.require_version("Gtk", "4.0")
 gi.require_version("GtkSource", "5")
-from gi.repository import Adw, Gdk, Gio, GObject, Gtk, GtkSource  # noqa: E402
+from gi.repository import Adw, Gdk, Gio, GLib, GObject, Gtk, GtkSource  # noqa: E402
+
+GObject.type_ensure(SymbolChooser)
+
+logger = logging.getLogger(__name__)
+
+GOTO_LINE_PATTERN = re.compile(r"^\s*(\d+)(?::(\d+))?\s*$")
 
 
 @Gtk.Template(resource_path="/io/github/vanillajonathan/pyrose/code_view.ui")
@@ -37,11 +48,29 @@ class CodeView(Gtk.Widget):
 
     def __init__(self):
         super().__init__()
-        GObject.type_ensure(SymbolChooser)
-        self.animate_fade_task: Task | None = None
+        self._fade_source_id: int | None = None
+        self._get_insert = self.buffer.get_insert
+        self._get_iter_at_mark = self.buffer.get_iter_at_mark
+        self._set_position_label = self.position_label.set_label
+        self._symbol_rect = Gdk.Rectangle()
+        self.set_file_task: Task | None = None
+        self.search_task: Task | None = None
+        self._last_diagnostics_hash: int | None = None
+        self._has_diagnostics = False
+        self._last_highlights_key: tuple | None = None
+        tag_table = self.buffer.get_tag_table()
+        self._diagnostic_tags: dict[str, Gtk.TextTag] = {
+            name: tag_table.lookup(name)
+            for name in ("error", "warning", "information", "hint", "deprecated")
+        }
         self.languages = []
-        self.search_context: GtkSource.SearchContext | None = None
+        self.position_encoding: str = PositionEncodingKind.UTF16
+        self._language_manager = GtkSource.LanguageManager.get_default()
         self.search_settings = GtkSource.SearchSettings()
+        self.search_settings.set_wrap_around(True)
+        self.search_context = GtkSource.SearchContext.new(
+            self.buffer, self.search_settings
+        )
 
         actions = (
             ("show-goto-line", self.reveal_goto),
@@ -57,22 +86,19 @@ class CodeView(Gtk.Widget):
 
         self.action_group = action_group
 
-        self.install_action("editor.goto-line", None, self.goto_line)
-        self.install_action("editor.search-hide", None, self.search_hide)
-        self.install_action("editor.search-next", None, self.search_next)
-        self.install_action("editor.search-prev", None, self.search_prev)
         self.action_set_enabled("editor.search-next", False)
         self.action_set_enabled("editor.search-prev", False)
 
+        scheme_manager = GtkSource.StyleSchemeManager.get_default()
+        self._scheme_dark = scheme_manager.get_scheme("Adwaita-dark")
+        self._scheme_light = scheme_manager.get_scheme("Adwaita")
         Adw.StyleManager.get_default().bind_property(
             "dark",
             self.buffer,
             "style-scheme",
             GObject.BindingFlags.SYNC_CREATE,
             lambda _, is_dark: self.buffer.set_style_scheme(
-                GtkSource.StyleSchemeManager.get_default().get_scheme(
-                    "Adwaita-dark" if is_dark else "Adwaita"
-                )
+                self._scheme_dark if is_dark else self._scheme_light
             ),
         )
 
@@ -81,15 +107,16 @@ class CodeView(Gtk.Widget):
             0, "Insert Symbol", "misc.insert-symbol"
         )
 
-        self.install_property_action("search-options.regex", "regex_enabled")
-        self.install_property_action("search-options.case-sensitive", "case_sensitive")
-        self.install_property_action(
-            "search-options.match-whole-word", "match_whole_word"
-        )
-        self.install_property_action("search.replace-mode", "replace_mode")
+    @property
+    def languages(self) -> list:
+        """The supported languages."""
+        return self._languages
 
-        self.install_action("search.replace-one", None, self.replace_one)
-        self.install_action("search.replace-all", None, self.replace_all)
+    @languages.setter
+    def languages(self, languages: list) -> None:
+        self._languages = languages
+        self._ext_to_langid = {item[2]: item[1] for item in languages}
+        self._supported_exts = frozenset(self._ext_to_langid)
 
     @GObject.Property(type=bool, default=False)
     def regex_enabled(self) -> bool:
@@ -136,6 +163,11 @@ class CodeView(Gtk.Widget):
         """Called every time the changed signal is emitted."""
         pass
 
+    @GObject.Signal(flags=GObject.SignalFlags.RUN_LAST, arg_types=(object,))
+    def text_changed(self, change: TextDocumentContentChangeEvent):
+        """Called every time text is inserted or deleted, before the edit."""
+        pass
+
     @GObject.Signal(flags=GObject.SignalFlags.RUN_LAST, arg_types=(GtkSource.Buffer,))
     def cursor_moved(self, buffer: GtkSource.Buffer):
         """Called every time the cursor-moved signal is emitted."""
@@ -152,14 +184,11 @@ class CodeView(Gtk.Widget):
     def on_droptarget_drop(
         self, target: Gtk.DropTarget, value, _x: float, _y: float
     ) -> bool:
-        def is_extension_supported(extension):
-            for item in self.languages:
-                if item[2] == extension:
-                    return True
-
         extension = os.path.splitext(value.get_basename())[1]
-        if is_extension_supported(extension):
-            self._set_file(value)
+        if extension in self._supported_exts:
+            if self.set_file_task is not None:
+                self.set_file_task.cancel()
+            self.set_file_task = asyncio.create_task(self._set_file(value))
             return True
         dialog = Adw.AlertDialog(
             heading="Unsupported file type",
@@ -169,44 +198,76 @@ class CodeView(Gtk.Widget):
         dialog.choose(self)
         return False
 
-    def _set_file(self, file) -> None:
-        def get_language_id(extension):
-            for item in self.languages:
-                if item[2] == extension:
-                    return item[1]
-            return ""
-
-        with open(file) as f:
-            extension = os.path.splitext(f.name)[1]
-            language_id = get_language_id(extension)
-            language_manager = GtkSource.LanguageManager.get_default()
-            language = language_manager.get_language(language_id)
-            self.buffer.set_language(language)
-            self.buffer.props.text = f.read()
+    async def _set_file(self, file: Gio.File) -> None:
+        extension = os.path.splitext(file.get_basename())[1]
+        language_id = self._ext_to_langid.get(extension, "")
+        language = self._language_manager.get_language(language_id)
+        self.buffer.set_language(language)
+        source_file = GtkSource.File(location=file)
+        loader = GtkSource.FileLoader.new(self.buffer, source_file)
+        try:
+            await loader.load_async(GLib.PRIORITY_DEFAULT, None, None, None)
+        except GLib.Error as e:
+            logger.warning("Could not load file: %s", e.message)
+            return
+        # The loader marks the buffer as unmodified, but the loaded text has
+        # not been saved to the buffer file yet.
+        self.buffer.set_modified(True)
 
     @Gtk.Template.Callback()
     def on_editor_changed(self, buffer: GtkSource.Buffer):
+        # Tags move along with edits, so they no longer match the ranges
+        # they were last applied from.
+        self._last_diagnostics_hash = None
+        self._last_highlights_key = None
         self.emit("changed", buffer)
 
+    @Gtk.Template.Callback()
+    def on_editor_insert_text(
+        self, buffer: GtkSource.Buffer, location: Gtk.TextIter, text: str, length: int
+    ):
+        position = self.get_position(location)
+        self.emit(
+            "text-changed",
+            {"range": {"start": position, "end": position}, "text": text},
+        )
+
+    @Gtk.Template.Callback()
+    def on_editor_delete_range(
+        self, buffer: GtkSource.Buffer, start: Gtk.TextIter, end: Gtk.TextIter
+    ):
+        self.emit(
+            "text-changed",
+            {
+                "range": {
+                    "start": self.get_position(start),
+                    "end": self.get_position(end),
+                },
+                "text": "",
+            },
+        )
+
     @Gtk.Template.Callback()
     def on_editor_cursor_moved(self, buffer: GtkSource.Buffer):
         self.sourceview.get_completion().hide()
-        insert_mark = buffer.get_insert()
-        cursor_iter = buffer.get_iter_at_mark(insert_mark)
+        cursor_iter = self._get_iter_at_mark(self._get_insert())
         line = cursor_iter.get_line()
         column = cursor_iter.get_line_offset()
-        self.position_label.set_label(f"Ln {line + 1}, Col {column + 1}")
+        self._set_position_label(f"Ln {line + 1}, Col {column + 1}")
 
-        async def animate_fade():
-            self.position_label.get_style_context().add_class("visible")
-            await asyncio.sleep(2)
-            self.position_label.get_style_context().remove_class("visible")
+        if not self.position_label.has_css_class("visible"):
+            self.position_label.add_css_class("visible")
 
-        if self.animate_fade_task is not None:
-            self.animate_fade_task.cancel()
-        self.animate_fade_task = asyncio.create_task(animate_fade())
+        if self._fade_source_id is not None:
+            GLib.source_remove(self._fade_source_id)
+        self._fade_source_id = GLib.timeout_add_seconds(2, self._hide_position_label)
         self.emit("cursor-moved", buffer)
 
+    def _hide_position_label(self) -> bool:
+        self.position_label.remove_css_class("visible")
+        self._fade_source_id = None
+        return GLib.SOURCE_REMOVE
+
     @Gtk.Template.Callback()
     def on_gestureclick_pressed(self, gesture, n_press: int, x: float, y: float):
         x, y = self.sourceview.window_to_buffer_coords(
@@ -222,8 +283,11 @@ class CodeView(Gtk.Widget):
 
     @Gtk.Template.Callback()
     def on_search_entry_activate(self, entry: Gtk.Entry):
+        # Apply a search that is still waiting out the delay before using it.
+        if self._cancel_search_task():
+            self._apply_search(entry.get_text())
         if entry.get_text():
-            self.search_next(None, None, None)
+            self.search_next(None, None)
         self.search_revealer.set_reveal_child(False)
         self.sourceview.grab_focus()
 
@@ -239,22 +303,33 @@ class CodeView(Gtk.Widget):
 
     @Gtk.Template.Callback()
     def on_search_changed(self, entry: Gtk.SearchEntry):
-        text = entry.get_text()
+        self._cancel_search_task()
+        self.search_task = asyncio.create_task(self._search(entry.get_text()))
+
+    def _cancel_search_task(self) -> bool:
+        """Cancel the pending search, returning whether one was pending."""
+        task, self.search_task = self.search_task, None
+        if task is None or task.done():
+            return False
+        task.cancel()
+        return True
+
+    async def _search(self, text: str, delay: float = 0.08) -> None:
+        await asyncio.sleep(delay)
+        self._apply_search(text)
+
+    def _apply_search(self, text: str) -> None:
         self.search_settings.set_search_text(text)
-        self.search_settings.set_wrap_around(True)
-        self.search_context = GtkSource.SearchContext.new(
-            self.buffer, self.search_settings
-        )
         self.search_context.forward(self.buffer.get_start_iter())
         if self.search_context.get_occurrences_count() == -1:
             self.action_set_enabled("editor.search-next", False)
             self.action_set_enabled("editor.search-prev", False)
         elif self.search_context.get_occurrences_count() == 0:
-            self.search_entry.get_style_context().add_class("error")
+            self.search_entry.add_css_class("error")
             self.action_set_enabled("editor.search-next", False)
             self.action_set_enabled("editor.search-prev", False)
         else:
-            self.search_entry.get_style_context().remove_class("error")
+            self.search_entry.remove_css_class("error")
             self.action_set_enabled("editor.search-next", True)
             self.action_set_enabled("editor.search-prev", True)
             cursor_iter = self.buffer.get_iter_at_mark(self.buffer.get_insert())
@@ -270,32 +345,43 @@ class CodeView(Gtk.Widget):
         self.buffer.insert_at_cursor(text)
 
     def apply_diagnostics(self, params: PublishDiagnosticsParams) -> None:
+        diagnostics_hash = hash(
+            tuple(
+                (
+                    d["range"]["start"]["line"],
+                    d["range"]["start"]["character"],
+                    d["range"]["end"]["line"],
+                    d["range"]["end"]["character"],
+                    d.get("severity"),
+                    tuple(d.get("tags", ())),
+                )
+                for d in params["diagnostics"]
+            )
+        )
+        if diagnostics_hash == self._last_diagnostics_hash:
+            return
         self.clear_diagnostics()
+        self._last_diagnostics_hash = diagnostics_hash
+        spans_by_tag: dict[str, list[tuple[int, int, int, int]]] = {}
         for diagnostic in params["diagnostics"]:
-            start_line = diagnostic["range"]["start"]["line"]
-            start_char = diagnostic["range"]["start"]["character"]
-            end_line = diagnostic["range"]["end"]["line"]
-            end_char = diagnostic["range"]["end"]["character"]
-            found_start, start_iter = self.buffer.get_iter_at_line_offset(
-                start_line, start_char
-            )
-            found_end, end_iter = self.buffer.get_iter_at_line_offset(
-                end_line, end_char
+            span = (
+                diagnostic["range"]["start"]["line"],
+                diagnostic["range"]["start"]["character"],
+                diagnostic["range"]["end"]["line"],
+                diagnostic["range"]["end"]["character"],
             )
-            if not found_start or not found_end:
-                continue
 
             match diagnostic.get("severity", DiagnosticSeverity.Error):
-                case DiagnosticSeverity.Error:
-                    text_tag = "error"
                 case DiagnosticSeverity.Warning:
                     text_tag = "warning"
                 case DiagnosticSeverity.Information:
                     text_tag = "information"
                 case DiagnosticSeverity.Hint:
                     text_tag = "hint"
+                case _:
+                    text_tag = "error"
 
-            self.buffer.apply_tag_by_name(text_tag, start_iter, end_iter)
+            spans_by_tag.setdefault(text_tag, []).append(span)
 
             tags = diagnostic.get("tags", [])
             for tag in tags:
@@ -303,18 +389,43 @@ class CodeView(Gtk.Widget):
                     case DiagnosticTag.Unnecessary:
                         pass
                     case DiagnosticTag.Deprecated:
-                        self.buffer.apply_tag_by_name(
-                            "deprecated", start_iter, end_iter
-                        )
+                        spans_by_tag.setdefault("deprecated", []).append(span)
+
+        for text_tag, spans in spans_by_tag.items():
+            tag = self._diagnostic_tags[text_tag]
+            for start_line, start_char, end_line, end_char in merge_spans(spans):
+                found_start, start_iter = self.get_iter_at_position(
+                    start_line, start_char
+                )
+                found_end, end_iter = self.get_iter_at_position(end_line, end_char)
+                if not found_start or not found_end:
+                    continue
+                self.buffer.apply_tag(tag, start_iter, end_iter)
+                self._has_diagnostics = True
 
     def clear_diagnostics(self) -> None:
-        tags = ["error", "warning", "information", "hint", "deprecated"]
+        self._last_diagnostics_hash = None
+        if not self._has_diagnostics:
+            return
         start_iter = self.buffer.get_start_iter()
         end_iter = self.buffer.get_end_iter()
-        for tag in tags:
-            self.buffer.remove_tag_by_name(tag, start_iter, end_iter)
+        for tag in self._diagnostic_tags.values():
+            self.buffer.remove_tag(tag, start_iter, end_iter)
+        self._has_diagnostics = False
 
     def highlight(self, highlights: list[DocumentHighlight] | None) -> None:
+        highlights_key = tuple(
+            (
+                h["range"]["start"]["line"],
+                h["range"]["start"]["character"],
+                h["range"]["end"]["line"],
+                h["range"]["end"]["character"],
+            )
+            for h in highlights or ()
+        )
+        if highlights_key == self._last_highlights_key:
+            return
+        self._last_highlights_key = highlights_key
         start_iter = self.buffer.get_start_iter()
         end_iter = self.buffer.get_end_iter()
         self.buffer.remove_tag_by_name("highlight", start_iter, end_iter)
@@ -325,25 +436,73 @@ class CodeView(Gtk.Widget):
             start_char = highlight["range"]["start"]["character"]
             end_line = highlight["range"]["end"]["line"]
             end_char = highlight["range"]["end"]["character"]
-            found_start, start_iter = self.buffer.get_iter_at_line_offset(
-                start_line, start_char
-            )
-            found_end, end_iter = self.buffer.get_iter_at_line_offset(
-                end_line, end_char
-            )
+            found_start, start_iter = self.get_iter_at_position(start_line, start_char)
+            found_end, end_iter = self.get_iter_at_position(end_line, end_char)
             if not found_start or not found_end:
                 continue
 
             self.buffer.apply_tag_by_name("highlight", start_iter, end_iter)
 
-    def goto_line(self, widget, action, parameter):
-        line, column = 0, 0
-        try:
-            line, column = self.goto_line_entry.get_text().split(":")
-        except ValueError:
-            line = self.goto_line_entry.get_text()
-        line = int(line)
-        column = int(column)
+    def get_iter_at_position(
+        self, line: int, character: int
+    ) -> tuple[bool, Gtk.TextIter]:
+        """Get an iterator at an LSP position.
+
+        Args:
+          line: The zero-based line.
+          character: The character offset in the position encoding.
+
+        Returns:
+          Whether the exact position was found, and the iterator.
+        """
+        if self.position_encoding == PositionEncodingKind.UTF8:
+            return self.buffer.get_iter_at_line_index(line, character)
+        if character and self.position_encoding == PositionEncodingKind.UTF16:
+            found, line_start = self.buffer.get_iter_at_line(line)
+            if not found:
+                return found, line_start
+            line_end = line_start.copy()
+            if not line_end.ends_line():
+                line_end.forward_to_line_end()
+            # Characters outside the BMP take two UTF-16 code units.
+            units = character
+            character = 0
+            for char in line_start.get_slice(line_end):
+                if units <= 0:
+                    break
+                units -= 2 if ord(char) > 0xFFFF else 1
+                character += 1
+            character += max(units, 0)
+        return self.buffer.get_iter_at_line_offset(line, character)
+
+    def get_position(self, text_iter: Gtk.TextIter) -> Position:
+        """Get the LSP position of an iterator.
+
+        Args:
+          text_iter: The iterator.
+
+        Returns:
+          The position in the position encoding.
+        """
+        if self.position_encoding == PositionEncodingKind.UTF8:
+            character = text_iter.get_line_index()
+        else:
+            character = text_iter.get_line_offset()
+            if character and self.position_encoding == PositionEncodingKind.UTF16:
+                # Characters outside the BMP take two UTF-16 code units.
+                line_start = text_iter.copy()
+                line_start.set_line_offset(0)
+                character = (
+                    len(line_start.get_slice(text_iter).encode("utf-16-le")) // 2
+                )
+        return {"line": text_iter.get_line(), "character": character}
+
+    def goto_line(self, action, parameter):
+        match = GOTO_LINE_PATTERN.match(self.goto_line_entry.get_text())
+        if not match:
+            return
+        line = int(match.group(1))
+        column = int(match.group(2) or 0)
         found, textiter = self.buffer.get_iter_at_line(line - 1)
         if found:
             if column and textiter.get_chars_in_line() > column:
@@ -368,15 +527,14 @@ class CodeView(Gtk.Widget):
         self.replace_mode = True
         self.reveal_search(action, parameter)
 
-    def search_hide(self, widget, action, parameter):
+    def search_hide(self, action, parameter):
+        self._cancel_search_task()
         self.replace_mode = False
         self.search_settings.set_search_text(None)
         self.search_revealer.set_reveal_child(False)
         self.sourceview.grab_focus()
 
-    def search_prev(self, widget, action, parameter):
-        if not self.search_context:
-            return
+    def search_prev(self, action, parameter):
         current_pos_iter = self.buffer.get_iter_at_mark(self.buffer.get_insert())
         match, start, end, wrapped = self.search_context.backward(current_pos_iter)
         if match:
@@ -384,9 +542,7 @@ class CodeView(Gtk.Widget):
             self.buffer.place_cursor(start)
             self.sourceview.scroll_to_iter(start, 0.1, False, 0, 0)
 
-    def search_next(self, widget, action, parameter):
-        if not self.search_context:
-            return
+    def search_next(self, action, parameter):
         current_pos_iter = self.buffer.get_iter_at_mark(self.buffer.get_insert())
         match, start, end, wrapped = self.search_context.forward(current_pos_iter)
         if match:
@@ -394,26 +550,60 @@ class CodeView(Gtk.Widget):
             self.buffer.place_cursor(end)
             self.sourceview.scroll_to_iter(start, 0.1, False, 0, 0)
 
-    def replace_one(self, widget, action: str, parameter):
+    def replace_one(self, action: str, parameter):
         bounds = self.buffer.get_selection_bounds()
         if bounds:
             start_iter, end_iter = bounds
             text = self.replace_entry.get_text()
-            assert self.search_context is not None
             self.search_context.replace(start_iter, end_iter, text, -1)
 
-    def replace_all(self, widget, action: str, parameter):
+    def replace_all(self, action: str, parameter):
         text = self.replace_entry.get_text()
-        assert self.search_context is not None
         self.search_context.replace_all(text, -1)
 
     def insert_symbol(self, view, action, parameter):
         insert_mark = self.buffer.get_insert()
         cursor_iter = self.buffer.get_iter_at_mark(insert_mark)
-        rect = view.get_iter_location(cursor_iter)
-        x, y = view.buffer_to_window_coords(Gtk.TextWindowType.WIDGET, rect.x, rect.y)
-        y, height = view.get_line_yrange(cursor_iter)
-        rect = Gdk.Rectangle()
-        rect.x, rect.y = x, y + height
+        location = view.get_iter_location(cursor_iter)
+        line_y, height = view.get_line_yrange(cursor_iter)
+        x, y = view.buffer_to_window_coords(
+            Gtk.TextWindowType.WIDGET, location.x, line_y + height
+        )
+        rect = self._symbol_rect
+        rect.x, rect.y = x, y
         self.symbol_chooser.set_pointing_to(rect)
         self.symbol_chooser.popup()
+
+
+CodeView.install_action("editor.goto-line", None, CodeView.goto_line)
+CodeView.install_action("editor.search-hide", None, CodeView.search_hide)
+CodeView.install_action("editor.search-next", None, CodeView.search_next)
+CodeView.install_action("editor.search-prev", None, CodeView.search_prev)
+CodeView.install_property_action("search-options.regex", "regex_enabled")
+CodeView.install_property_action("search-options.case-sensitive", "case_sensitive")
+CodeView.install_property_action("search-options.match-whole-word", "match_whole_word")
+CodeView.install_property_action("search.replace-mode", "replace_mode")
+CodeView.install_action("search.replace-one", None, CodeView.replace_one)
+CodeView.install_action("search.replace-all", None, CodeView.replace_all)
+
+
+def merge_spans(
+    spans: list[tuple[int, int, int, int]],
+) -> list[tuple[int, int, int, int]]:
+    """Merge overlapping and duplicate text spans.
+
+    Args:
+      spans: Spans as (start line, start character, end line, end character).
+
+    Returns:
+      The spans sorted by start position with overlapping spans merged.
+    """
+    merged: list[tuple[int, int, int, int]] = []
+    for span in sorted(spans):
+        if merged and span[:2] <= merged[-1][2:]:
+            last = merged[-1]
+            if span[2:] > last[2:]:
+                merged[-1] = (last[0], last[1], span[2], span[3])
+            continue
+        merged.append(span)
+    return merged
@@ -1,19 +1,66 @@
 import asyncio
+import weakref
 import lsp_types as lsp
 
+from asyncio import Task
+from collections.abc import Callable
 from gettext import gettext as _
-from gi.repository import Gio, GObject, Gtk, GtkSource
+from gi.repository import Gio, GLib, GObject, Gtk, GtkSource
 from gi.repository.GtkSource import CompletionActivation
 from .lsp_client import LspClient
 from .pango_utils import markdown_to_pango
 
+CLASS_KIND = lsp.CompletionItemKind.Class.value
+DEPRECATED_TAG = lsp.CompletionItemTag.Deprecated.value
+
+KIND_TO_CSS: dict[int, str] = {
+    lsp.CompletionItemKind.Text.value: "lang-text",
+    lsp.CompletionItemKind.Method.value: "lang-method",
+    lsp.CompletionItemKind.Function.value: "lang-function",
+    lsp.CompletionItemKind.Constructor.value: "lang-constructor",
+    lsp.CompletionItemKind.Field.value: "lang-field",
+    lsp.CompletionItemKind.Variable.value: "lang-variable",
+    lsp.CompletionItemKind.Class.value: "lang-class",
+    lsp.CompletionItemKind.Interface.value: "lang-interface",
+    lsp.CompletionItemKind.Module.value: "lang-module",
+    lsp.CompletionItemKind.Property.value: "lang-property",
+    lsp.CompletionItemKind.Unit.value: "lang-unit",
+    lsp.CompletionItemKind.Value.value: "lang-value",
+    lsp.CompletionItemKind.Enum.value: "lang-enum",
+    lsp.CompletionItemKind.Keyword.value: "lang-keyword",
+    lsp.CompletionItemKind.Snippet.value: "lang-snippet",
+    lsp.CompletionItemKind.Color.value: "lang-color",
+    lsp.CompletionItemKind.File.value: "lang-file",
+    lsp.CompletionItemKind.Reference.value: "lang-reference",
+    lsp.CompletionItemKind.Folder.value: "lang-folder",
+    lsp.CompletionItemKind.EnumMember.value: "lang-enum-member",
+    lsp.CompletionItemKind.Constant.value: "lang-constant",
+    lsp.CompletionItemKind.Struct.value: "lang-struct",
+    lsp.CompletionItemKind.Event.value: "lang-event",
+    lsp.CompletionItemKind.Operator.value: "lang-operator",
+    lsp.CompletionItemKind.TypeParameter.value: "lang-type-parameter",
+}
+
+KIND_TO_CSS_CLASSES: dict[int, tuple[str, ...]] = {
+    kind: ("cell", "icon", css_class) for kind, css_class in KIND_TO_CSS.items()
+}
+DEFAULT_CSS_CLASSES = ("cell", "icon", "")
+EXCEPTION_CSS_CLASSES = ("cell", "icon", "lang-exception")
+ICON_NAME = "circle-outline-thick-symbolic"
+
+KIND_TO_TEXT: dict[int, str] = {
+    kind.value: kind.name for kind in lsp.CompletionItemKind
+}
+
 
 class CompletionProposal(GObject.Object, GtkSource.CompletionProposal):
+    text = GObject.Property(type=str, default="")
+
     def __init__(self, item: lsp.CompletionItem):
         super().__init__()
         self.item = item
         self.label: str = item["label"]
-        self.text: str = item["label"]
+        self.text = item["label"]
         self.kind: lsp.CompletionItemKind | None = item.get("kind")
         self.info: str = ""
         self.sort_text = item.get("sortText", self.label)
@@ -22,14 +69,23 @@ class CompletionProposal(GObject.Object, GtkSource.CompletionProposal):
         self.label_details: lsp.CompletionItemLabelDetails | None = item.get(
             "labelDetails"
         )
-
-    def is_deprecated(self) -> bool:
-        """Whether the completion item is deprecated."""
-        if lsp.CompletionItemTag.Deprecated in self.item.get("tags", []):
-            return True
-        if self.item.get("deprecated"):
-            return True
-        return False
+        tags = item.get("tags")
+        self.deprecated: bool = bool(item.get("deprecated")) or (
+            tags is not None and DEPRECATED_TAG in tags
+        )
+        self.typed_markup: str | None = None
+        self.documentation_markup: str | None = None
+        after = []
+        if self.deprecated:
+            after.append(_("Deprecated"))
+        if self.label_details:
+            if details := self.label_details.get("detail"):
+                after.append(details)
+            if description := self.label_details.get("description"):
+                after.append(description)
+        self.after_text: str = "".join(after)
+        if self.deprecated:
+            self.typed_markup = f"<s>{GLib.markup_escape_text(self.text)}</s>"
 
 
 class FilterData:
@@ -42,16 +98,32 @@ class CompletionProvider(GObject.GObject, GtkSource.CompletionProvider):
     Args:
       client: The LSP client.
       uri: The URI for the document being edited.
+      get_position: Converts a text iterator to an LSP position in the
+        negotiated position encoding.
 
     Attributes:
       uri: The URI for the document being edited.
     """
 
-    def __init__(self, client: LspClient, uri: lsp.DocumentUri):
+    def __init__(
+        self,
+        client: LspClient,
+        uri: lsp.DocumentUri,
+        get_position: Callable[[Gtk.TextIter], lsp.Position],
+    ):
         super().__init__()
         self.uri = uri
         self._client = client
+        self._get_position = get_position
         self._filter_data: FilterData = FilterData()
+        self._store = Gio.ListStore.new(CompletionProposal)
+        expression = Gtk.PropertyExpression.new(CompletionProposal, None, "text")
+        self._filter = Gtk.StringFilter.new(expression)
+        self._filter.set_match_mode(Gtk.StringFilterMatchMode.PREFIX)
+        self._filter.set_ignore_case(False)
+        self._proposals = Gtk.FilterListModel.new(self._store, self._filter)
+        self._context_ref: weakref.ref[GtkSource.CompletionContext] | None = None
+        self._complete_task: Task | None = None
 
     def do_activate(self, context: GtkSource.CompletionContext, proposal) -> None:
         if buffer := context.get_buffer():
@@ -68,31 +140,19 @@ class CompletionProvider(GObject.GObject, GtkSource.CompletionProvider):
         proposal: CompletionProposal,
         cell: GtkSource.CompletionCell,
     ) -> None:
-        language = ""
-        if language := context.get_language():
-            language = language.props.id
-
         if cell.props.column == GtkSource.CompletionColumn.ICON:
-            self._set_icon(cell, proposal, language)
+            self._set_icon(cell, proposal)
         elif cell.props.column == GtkSource.CompletionColumn.BEFORE:
             cell.set_text(self._get_text(proposal.kind))
             pass
         elif cell.props.column == GtkSource.CompletionColumn.TYPED_TEXT:
-            if proposal.is_deprecated():
-                cell.set_markup(f"<s>{proposal.text}</s>")
+            if proposal.typed_markup:
+                cell.set_markup(proposal.typed_markup)
             else:
                 cell.set_text(proposal.text)
         elif cell.props.column == GtkSource.CompletionColumn.AFTER:
-            text = ""
-            if proposal.is_deprecated():
-                text += _("Deprecated")
-            if proposal.label_details:
-                if details := proposal.label_details.get("detail"):
-                    text += details
-                if description := proposal.label_details.get("description"):
-                    text += description
-            if text:
-                cell.set_text(text)
+            if proposal.after_text:
+                cell.set_text(proposal.after_text)
         elif cell.props.column == GtkSource.CompletionColumn.COMMENT:
             if proposal.detail:
                 cell.set_text(proposal.detail)
@@ -111,141 +171,40 @@ class CompletionProvider(GObject.GObject, GtkSource.CompletionProvider):
             else:
                 match proposal.documentation["kind"]:
                     case lsp.MarkupKind.Markdown:
-                        markup = markdown_to_pango(proposal.documentation["value"])
-                        cell.set_markup(markup)
+                        if proposal.documentation_markup is None:
+                            proposal.documentation_markup = markdown_to_pango(
+                                proposal.documentation["value"]
+                            )
+                        cell.set_markup(proposal.documentation_markup)
                     case lsp.MarkupKind.PlainText:
                         cell.set_text(proposal.documentation["value"])
 
-    def _set_icon(
-        self, cell: GtkSource.CompletionCell, proposal, language: str
-    ) -> None:
-        match proposal.kind:
-            case lsp.CompletionItemKind.Text.value:
-                css_class = "lang-text"
-            case lsp.CompletionItemKind.Method.value:
-                css_class = "lang-method"
-            case lsp.CompletionItemKind.Function.value:
-                css_class = "lang-function"
-            case lsp.CompletionItemKind.Constructor.value:
-                css_class = "lang-constructor"
-            case lsp.CompletionItemKind.File.value:
-                css_class = "lang-field"
-            case lsp.CompletionItemKind.Variable.value:
-                css_class = "lang-variable"
-            case lsp.CompletionItemKind.Class.value:
-                css_class = "lang-class"
-                if proposal.label.endswith("Error"):
-                    css_class = "lang-exception"
-            case lsp.CompletionItemKind.Interface.value:
-                css_class = "lang-interface"
-            case lsp.CompletionItemKind.Module.value:
-                css_class = "lang-module"
-            case lsp.CompletionItemKind.Property.value:
-                css_class = "lang-property"
-            case lsp.CompletionItemKind.Unit.value:
-                css_class = "lang-unit"
-            case lsp.CompletionItemKind.Value.value:
-                css_class = "lang-value"
-            case lsp.CompletionItemKind.Enum.value:
-                css_class = "lang-enum"
-            case lsp.CompletionItemKind.Keyword.value:
-                css_class = "lang-keyword"
-            case lsp.CompletionItemKind.Snippet.value:
-                css_class = "lang-snippet"
-            case lsp.CompletionItemKind.Color.value:
-                css_class = "lang-color"
-            case lsp.CompletionItemKind.File.value:
-                css_class = "lang-file"
-            case lsp.CompletionItemKind.Reference.value:
-                css_class = "lang-reference"
-            case lsp.CompletionItemKind.Folder.value:
-                css_class = "lang-folder"
-            case lsp.CompletionItemKind.EnumMember.value:
-                css_class = "lang-enum-member"
-            case lsp.CompletionItemKind.Constant.value:
-                css_class = "lang-constant"
-            case lsp.CompletionItemKind.Struct.value:
-                css_class = "lang-struct"
-            case lsp.CompletionItemKind.Event.value:
-                css_class = "lang-event"
-            case lsp.CompletionItemKind.Operator.value:
-                css_class = "lang-operator"
-            case lsp.CompletionItemKind.TypeParameter.value:
-                css_class = "lang-type-parameter"
-            case _:
-                css_class = ""
+    def _set_icon(self, cell: GtkSource.CompletionCell, proposal) -> None:
+        if proposal.kind == CLASS_KIND and proposal.label.endswith("Error"):
+            css_classes = EXCEPTION_CSS_CLASSES
+        else:
+            css_classes = KIND_TO_CSS_CLASSES.get(proposal.kind, DEFAULT_CSS_CLASSES)
 
-        cell.set_css_classes(["cell", "icon", css_class])
-        cell.set_icon_name("circle-outline-thick-symbolic")
+        cell.set_css_classes(css_classes)
+        cell.set_icon_name(ICON_NAME)
 
     def _get_text(self, kind: int) -> str:
-        match kind:
-            case lsp.CompletionItemKind.Text.value:
-                return "Text"
-            case lsp.CompletionItemKind.Method.value:
-                return "Method"
-            case lsp.CompletionItemKind.Function.value:
-                return "Function"
-            case lsp.CompletionItemKind.Constructor.value:
-                return "Constructor"
-            case lsp.CompletionItemKind.Field.value:
-                return "Field"
-            case lsp.CompletionItemKind.Variable.value:
-                return "Variable"
-            case lsp.CompletionItemKind.Class.value:
-                return "Class"
-            case lsp.CompletionItemKind.Interface.value:
-                return "Interface"
-            case lsp.CompletionItemKind.Module.value:
-                return "Module"
-            case lsp.CompletionItemKind.Property.value:
-                return "Property"
-            case lsp.CompletionItemKind.Unit.value:
-                return "Unit"
-            case lsp.CompletionItemKind.Value.value:
-                return "Value"
-            case lsp.CompletionItemKind.Enum.value:
-                return "Enum"
-            case lsp.CompletionItemKind.Keyword.value:
-                return "Keyword"
-            case lsp.CompletionItemKind.Snippet.value:
-                return "Snippet"
-            case lsp.CompletionItemKind.Color.value:
-                return "Color"
-            case lsp.CompletionItemKind.File.value:
-                return "File"
-            case lsp.CompletionItemKind.Reference.value:
-                return "Reference"
-            case lsp.CompletionItemKind.Folder.value:
-                return "Folder"
-            case lsp.CompletionItemKind.EnumMember.value:
-                return "EnumMember"
-            case lsp.CompletionItemKind.Constant.value:
-                return "Constant"
-            case lsp.CompletionItemKind.Struct.value:
-                return "Struct"
-            case lsp.CompletionItemKind.Event.value:
-                return "Event"
-            case lsp.CompletionItemKind.Operator.value:
-                return "Operator"
-            case lsp.CompletionItemKind.TypeParameter.value:
-                return "TypeParameter"
-            case _:
-                return ""
+        return KIND_TO_TEXT.get(kind, "")
 
     def do_is_trigger(self, text_iter: Gtk.TextIter, ch: str) -> bool:
-        if ch != "." and ch != "(":
+        if ch not in ".(":
             return False
-        success = text_iter.backward_char()
-        if not success:
+        text_iter = text_iter.copy()
+        if not text_iter.backward_char():
             return False
         return text_iter.ends_word()
 
     def do_populate_async(self, context, cancellable, callback, user_data=None) -> None:
-        asyncio.create_task(self._complete(context))
+        if self._complete_task is not None and not self._complete_task.done():
+            self._complete_task.cancel()
+        self._complete_task = asyncio.create_task(self._complete(context))
 
     async def _complete(self, context: GtkSource.CompletionContext):
-        store = Gio.ListStore.new(CompletionProposal)
         self._filter_data.word = context.get_word()
 
         buffer = context.get_buffer()
@@ -253,12 +212,10 @@ class CompletionProvider(GObject.GObject, GtkSource.CompletionProvider):
             return
         insert_mark = buffer.get_insert()
         cursor_iter = buffer.get_iter_at_mark(insert_mark)
-        line = cursor_iter.get_line()
-        column = cursor_iter.get_line_offset()
 
         params: lsp.CompletionParams = {
             "textDocument": {"uri": self.uri},
-            "position": {"line": line, "character": column},
+            "position": self._get_position(cursor_iter),
         }
 
         activation = context.get_activation()
@@ -286,24 +243,14 @@ class CompletionProvider(GObject.GObject, GtkSource.CompletionProvider):
         else:
             items: list[lsp.CompletionItem] = result["items"]
 
-        for item in items:
-            proposal = CompletionProposal(item)
-            store.append(proposal)
-
-        def filter_fn(proposal, data) -> bool:
-            return proposal.text.startswith(data.word)
-
-        store_filter = Gtk.CustomFilter.new(filter_fn, self._filter_data)
-        proposals = Gtk.FilterListModel.new(store, store_filter)
-        context.set_proposals_for_provider(self, proposals)
+        new_proposals = [CompletionProposal(item) for item in items]
+        self._filter.set_search(self._filter_data.word)
+        self._store.splice(0, self._store.get_n_items(), new_proposals)
+        if self._context_ref is None or self._context_ref() is not context:
+            context.set_proposals_for_provider(self, self._proposals)
+            self._context_ref = weakref.ref(context)
 
     def do_refilter(self, context: GtkSource.CompletionContext, model) -> None:
         word = context.get_word()
-        old_word = self._filter_data.word
-        change = Gtk.FilterChange.DIFFERENT
-        if old_word and word.startswith(old_word):
-            change = Gtk.FilterChange.MORE_STRICT
-        elif old_word and old_word.startswith(word):
-            change = Gtk.FilterChange.LESS_STRICT
         self._filter_data.word = word
-        model.get_filter().changed(change)
+        model.get_filter().set_search(word)
@@ -1,6 +1,8 @@
+import functools
+import json
 import os
 import platform
-import subprocess
+import shutil
 import gi
 import lsp_types as lsp
 
@@ -9,47 +11,160 @@ gi.require_version("Gdk", "4.0")
 gi.require_version("Gtk", "4.0")
 gi.require_version("GtkSource", "5")
 gi.require_version("Vte", "3.91")
-from gi.repository import Adw, Gtk, GtkSource, GLib, Vte  # noqa: E402
-
-
-def get_debug_info(version, settings) -> str:
-    debug_info = f"PyRose {version}\n\n"
-    debug_info += f"{GLib.get_os_info('PRETTY_NAME')}\n"
-    debug_info += (
-        f"GLib {GLib.MAJOR_VERSION}.{GLib.MINOR_VERSION}.{GLib.MICRO_VERSION}\n"
-    )
-    debug_info += f"GTK {Gtk.MAJOR_VERSION}.{Gtk.MINOR_VERSION}.{Gtk.MICRO_VERSION}\n"
-    debug_info += f"GtkSourceView {GtkSource.MAJOR_VERSION}.{GtkSource.MINOR_VERSION}.{GtkSource.MICRO_VERSION}\n"
-
-    debug_info += "PyGObject {}.{}.{}\n".format(
-        *gi.version_info  # pyrefly: ignore[missing-attribute]
-    )
-    debug_info += (
-        f"libadwaita {Adw.MAJOR_VERSION}.{Adw.MINOR_VERSION}.{Adw.MICRO_VERSION}\n"
-    )
-    debug_info += (
-        f"libvte {Vte.MAJOR_VERSION}.{Vte.MINOR_VERSION}.{Vte.MICRO_VERSION}\n"
-    )
-    debug_info += f"Python {platform.python_version()}\n"
+from gi.repository import Adw, Gio, Gtk, GtkSource, GLib, Vte  # noqa: E402
 
-    try:
-        result = subprocess.run(["pyrefly", "--version"], capture_output=True)
-        debug_info += result.stdout.decode() + "\n\n"
-    except FileNotFoundError:
-        debug_info += "The Python LSP server Pyrefly was not found.\n\n"
-
-    debug_info += "Environment variables:\n"
-    debug_info += f"- LANG: {os.environ.get('LANG')}\n"
-    for env in os.environ:
+
+@functools.cache
+def get_settings() -> Gio.Settings:
+    """Get the application settings.
+
+    The settings object is created on first use and shared by all callers.
+
+    Returns:
+      The application settings.
+    """
+    return Gio.Settings.new("io.github.vanillajonathan.pyrose")
+
+
+def get_debug_info(version, settings, pyrefly_version) -> str:
+    parts = [
+        f"PyRose {version}\n\n",
+        f"{GLib.get_os_info('PRETTY_NAME')}\n",
+        f"GLib {GLib.MAJOR_VERSION}.{GLib.MINOR_VERSION}.{GLib.MICRO_VERSION}\n",
+        f"GTK {Gtk.MAJOR_VERSION}.{Gtk.MINOR_VERSION}.{Gtk.MICRO_VERSION}\n",
+        f"GtkSourceView {GtkSource.MAJOR_VERSION}.{GtkSource.MINOR_VERSION}.{GtkSource.MICRO_VERSION}\n",
+        "PyGObject {}.{}.{}\n".format(
+            *gi.version_info  # pyrefly: ignore[missing-attribute]
+        ),
+        f"libadwaita {Adw.MAJOR_VERSION}.{Adw.MINOR_VERSION}.{Adw.MICRO_VERSION}\n",
+        f"libvte {Vte.MAJOR_VERSION}.{Vte.MINOR_VERSION}.{Vte.MICRO_VERSION}\n",
+        f"Python {platform.python_version()}\n",
+    ]
+
+    if pyrefly_version:
+        parts.append(pyrefly_version + "\n\n")
+    else:
+        parts.append("The Python LSP server Pyrefly was not found.\n\n")
+
+    parts.append("Environment variables:\n")
+    parts.append(f"- LANG: {os.environ.get('LANG')}\n")
+    for env, value in os.environ.items():
         if env.startswith(("GTK_", "GDK", "PYTHON")):
-            debug_info += f"- {env}:  {os.environ.get(env)}\n"
-    debug_info += "\n"
+            parts.append(f"- {env}:  {value}\n")
+    parts.append("\n")
 
-    debug_info += "Settings:\n"
+    parts.append("Settings:\n")
     schema = settings.props.settings_schema
     for key in schema.list_keys():
-        debug_info += f"- {key}: {settings.get_value(key)}\n"
-    return debug_info
+        parts.append(f"- {key}: {settings.get_value(key)}\n")
+    return "".join(parts)
+
+
+def find_programs(*names: str) -> dict[str, str | None]:
+    """Find programs in the PATH.
+
+    Found programs are cached on disk for as long as the PATH stays the same,
+    so later runs only have to check that the cached files are executable.
+
+    Args:
+      names: The names of the programs to find.
+
+    Returns:
+      The path of each program, or None if it was not found.
+    """
+    search_path = os.environ.get("PATH", "")
+    cache_path = os.path.join(GLib.get_user_cache_dir(), "pyrose", "tools.json")
+    try:
+        with open(cache_path, encoding="utf-8") as f:
+            cache = json.load(f)
+        if cache["path"] != search_path:
+            raise ValueError("PATH has changed")
+        cached_programs: dict[str, str] = cache["programs"]
+    except (OSError, ValueError, KeyError, TypeError):
+        cached_programs = {}
+
+    programs: dict[str, str | None] = {}
+    found_programs: dict[str, str] = {}
+    for name in names:
+        program = cached_programs.get(name)
+        if not program or not os.access(program, os.X_OK):
+            program = shutil.which(name)
+        programs[name] = program
+        if program:
+            found_programs[name] = program
+
+    if found_programs != cached_programs:
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            with open(cache_path, "w", encoding="utf-8") as f:
+                json.dump({"path": search_path, "programs": found_programs}, f)
+        except OSError:
+            pass
+    return programs
+
+
+CLIENT_CAPABILITIES: lsp.ClientCapabilities = {
+    "textDocument": {
+        "completion": {
+            "completionItem": {
+                "snippetSupport": False,
+                "documentationFormat": [
+                    lsp.MarkupKind.Markdown,
+                    lsp.MarkupKind.PlainText,
+                ],
+                "deprecatedSupport": True,
+                "tagSupport": {"valueSet": [lsp.CompletionItemTag.Deprecated]},
+                "labelDetailsSupport": True,
+            },
+            "completionItemKind": {
+                "valueSet": [
+                    lsp.CompletionItemKind.Text,
+                    lsp.CompletionItemKind.Method,
+                    lsp.CompletionItemKind.Function,
+                    lsp.CompletionItemKind.Constructor,
+                    lsp.CompletionItemKind.Field,
+                    lsp.CompletionItemKind.Variable,
+                    lsp.CompletionItemKind.Class,
+                    lsp.CompletionItemKind.Interface,
+                    lsp.CompletionItemKind.Module,
+                    lsp.CompletionItemKind.Property,
+                    lsp.CompletionItemKind.Unit,
+                    lsp.CompletionItemKind.Value,
+                    lsp.CompletionItemKind.Enum,
+                    lsp.CompletionItemKind.Keyword,
+                    lsp.CompletionItemKind.Snippet,
+                    lsp.CompletionItemKind.Color,
+                    lsp.CompletionItemKind.File,
+                    lsp.CompletionItemKind.Reference,
+                    lsp.CompletionItemKind.Folder,
+                    lsp.CompletionItemKind.EnumMember,
+                    lsp.CompletionItemKind.Constant,
+                    lsp.CompletionItemKind.Struct,
+                    lsp.CompletionItemKind.Event,
+                    lsp.CompletionItemKind.Operator,
+                    lsp.CompletionItemKind.TypeParameter,
+                ]
+            },
+            # "contextSupport": True
+        },
+        "hover": {"contentFormat": [lsp.MarkupKind.Markdown, lsp.MarkupKind.PlainText]},
+        "publishDiagnostics": {
+            "tagSupport": {
+                "valueSet": [
+                    lsp.DiagnosticTag.Unnecessary,
+                    lsp.DiagnosticTag.Deprecated,
+                ]
+            }
+        },
+    },
+    "general": {
+        "regularExpressions": {
+            "engine": "Python",
+            "version": platform.python_version(),
+        },
+        "positionEncodings": [lsp.PositionEncodingKind.UTF8],
+    },
+}
 
 
 def get_initialize_params(version: str) -> lsp.InitializeParams:
@@ -66,70 +181,7 @@ def get_initialize_params(version: str) -> lsp.InitializeParams:
         "clientInfo": {"name": "PyRose", "version": version},
         "locale": "en",
         "rootUri": None,
-        "capabilities": {
-            "textDocument": {
-                "completion": {
-                    "completionItem": {
-                        "snippetSupport": False,
-                        "documentationFormat": [
-                            lsp.MarkupKind.Markdown,
-                            lsp.MarkupKind.PlainText,
-                        ],
-                        "deprecatedSupport": True,
-                        "tagSupport": {"valueSet": [lsp.CompletionItemTag.Deprecated]},
-                        "labelDetailsSupport": True,
-                    },
-                    "completionItemKind": {
-                        "valueSet": [
-                            lsp.CompletionItemKind.Text,
-                            lsp.CompletionItemKind.Method,
-                            lsp.CompletionItemKind.Function,
-                            lsp.CompletionItemKind.Constructor,
-                            lsp.CompletionItemKind.Field,
-                            lsp.CompletionItemKind.Variable,
-                            lsp.CompletionItemKind.Class,
-                            lsp.CompletionItemKind.Interface,
-                            lsp.CompletionItemKind.Module,
-                            lsp.CompletionItemKind.Property,
-                            lsp.CompletionItemKind.Unit,
-                            lsp.CompletionItemKind.Value,
-                            lsp.CompletionItemKind.Enum,
-                            lsp.CompletionItemKind.Keyword,
-                            lsp.CompletionItemKind.Snippet,
-                            lsp.CompletionItemKind.Color,
-                            lsp.CompletionItemKind.File,
-                            lsp.CompletionItemKind.Reference,
-                            lsp.CompletionItemKind.Folder,
-                            lsp.CompletionItemKind.EnumMember,
-                            lsp.CompletionItemKind.Constant,
-                            lsp.CompletionItemKind.Struct,
-                            lsp.CompletionItemKind.Event,
-                            lsp.CompletionItemKind.Operator,
-                            lsp.CompletionItemKind.TypeParameter,
-                        ]
-                    },
-                    # "contextSupport": True
-                },
-                "hover": {
-                    "contentFormat": [lsp.MarkupKind.Markdown, lsp.MarkupKind.PlainText]
-                },
-                "publishDiagnostics": {
-                    "tagSupport": {
-                        "valueSet": [
-                            lsp.DiagnosticTag.Unnecessary,
-                            lsp.DiagnosticTag.Deprecated,
-                        ]
-                    }
-                },
-            },
-            "general": {
-                "regularExpressions": {
-                    "engine": "Python",
-                    "version": platform.python_version(),
-                },
-                "positionEncodings": [lsp.PositionEncodingKind.UTF8],
-            },
-        },
+        "capabilities": CLIENT_CAPABILITIES,
         "trace": lsp.TraceValue.Off,
     }
 
@@ -1,9 +1,13 @@
 import asyncio
+import functools
 import lsp_types as lsp
+from collections.abc import Callable
 from .lsp_client import LspClient
 from .pango_utils import markdown_to_pango
 from gi.repository import GObject, Gtk, GtkSource
 
+cached_markdown_to_pango = functools.lru_cache(maxsize=32)(markdown_to_pango)
+
 
 class HoverProvider(GObject.GObject, GtkSource.HoverProvider):
     """LSP-powered hover provider for source view.
@@ -11,15 +15,24 @@ class HoverProvider(GObject.GObject, GtkSource.HoverProvider):
     Args:
       client: The LSP client.
       uri: The URI for the document being edited.
+      get_position: Converts a text iterator to an LSP position in the
+        negotiated position encoding.
 
     Attributes:
       uri: The URI for the document being edited.
     """
 
-    def __init__(self, client: LspClient, uri: lsp.DocumentUri):
+    def __init__(
+        self,
+        client: LspClient,
+        uri: lsp.DocumentUri,
+        get_position: Callable[[Gtk.TextIter], lsp.Position],
+    ):
         super().__init__()
         self.uri = uri
         self._client = client
+        self._get_position = get_position
+        self._placeholder = Gtk.Label()
 
     """
     def do_populate_async(
@@ -34,12 +47,25 @@ class HoverProvider(GObject.GObject, GtkSource.HoverProvider):
     """
 
     def do_populate(self, context, display):
-        display.append(Gtk.Label())
+        # The label is shared, so take it back from an earlier display first.
+        # The assistant clears a reused display, which also unparents it.
+        if self._get_placeholder_display() is not display:
+            self._remove_placeholder()
+            display.append(self._placeholder)
         asyncio.create_task(self._hover(context, display))
         return True
 
     async def _hover(
         self, context: GtkSource.HoverContext, display: GtkSource.HoverDisplay
+    ):
+        try:
+            await self._populate(context, display)
+        finally:
+            if self._get_placeholder_display() is display:
+                self._remove_placeholder()
+
+    async def _populate(
+        self, context: GtkSource.HoverContext, display: GtkSource.HoverDisplay
     ):
         success, hover_iter = context.get_iter()
         if not success:
@@ -47,10 +73,7 @@ class HoverProvider(GObject.GObject, GtkSource.HoverProvider):
 
         params: lsp.HoverParams = {
             "textDocument": {"uri": self.uri},
-            "position": {
-                "line": hover_iter.get_line(),
-                "character": hover_iter.get_line_offset(),
-            },
+            "position": self._get_position(hover_iter),
         }
         data = await self._client.requests.hover(params)
 
@@ -66,10 +89,18 @@ class HoverProvider(GObject.GObject, GtkSource.HoverProvider):
             text = contents["value"]
             match kind:
                 case lsp.MarkupKind.Markdown:
-                    label.set_markup(markdown_to_pango(text))
+                    label.set_markup(cached_markdown_to_pango(text))
                 case lsp.MarkupKind.PlainText:
                     label.set_text(text)
         else:
             return
 
         display.prepend(label)
+
+    def _get_placeholder_display(self) -> GtkSource.HoverDisplay | None:
+        # The display packs its children into an inner box.
+        return self._placeholder.get_ancestor(GtkSource.HoverDisplay)
+
+    def _remove_placeholder(self) -> None:
+        if (display := self._get_placeholder_display()) is not None:
+            display.remove(self._placeholder)
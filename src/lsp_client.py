@@ -7,14 +7,30 @@ from collections.abc import AsyncGenerator, Callable, Coroutine, Mapping
 from typing import Any
 import asyncio
 
-# import difflib
 import json
 import logging
-import uuid
 import lsp_types as lsp
 
+# orjson is an optional, undeclared speedup; the stdlib json is the default.
+try:
+    from orjson import dumps as json_dumps
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+    def json_dumps(obj: Any) -> bytes:
+        return json.dumps(obj).encode("utf-8")
+
+
 logger = logging.getLogger(__name__)
 
+MAX_BATCH_SIZE = 64
+READ_SIZE = 65536
+CHANGE_DELAY = 0.05
+EXIT_TIMEOUT = 1.0
+NOTIFICATION_PREFIX = b'{"jsonrpc":"2.0","method":"%s","params":'
+NOTIFICATION_WITHOUT_PARAMS = b'{"jsonrpc":"2.0","method":"%s"}'
+
 
 class JsonRpcDispatcher:
     """A JSON-RPC dispatcher.
@@ -27,24 +43,30 @@ class JsonRpcDispatcher:
     def __init__(self, reader: StreamReader, writer: StreamWriter):
         self.on_close: Callable[[], None] | None = None
         self.on_notification: Callable[[str, Any], None] | None = None
-        self._callback_id: int = 1
-        self._callbacks: dict[int, Future] = {}
+        self._callbacks: list[Future | None] = [None]
+        self._free_callback_ids: list[int] = []
         self._reader: StreamReader = reader
         self._writer: StreamWriter = writer
         self._read_loop_task: Task | None = None
+        self._write_loop_task: Task | None = None
+        self._send_queue: asyncio.Queue[dict | tuple[str, Any]] = asyncio.Queue()
 
     async def start(self) -> None:
         """Start listening for messages from the JSON-RPC server."""
         self._read_loop_task = asyncio.create_task(self._read_loop())
+        self._write_loop_task = asyncio.create_task(self._write_loop())
 
     def stop(self) -> None:
         """Stop processing messages from the JSON-RPC server."""
         if self._read_loop_task:
             self._read_loop_task.cancel()
-        for _, callback in self._callbacks.items():
-            callback.cancel()
-        self._callback_id = 1
-        self._callbacks.clear()
+        if self._write_loop_task:
+            self._write_loop_task.cancel()
+        for callback in self._callbacks:
+            if callback is not None:
+                callback.cancel()
+        self._callbacks = [None]
+        self._free_callback_ids = []
 
     async def send(
         self, method: str, params: lsp.LSPArray | lsp.LSPObject | None
@@ -60,9 +82,13 @@ class JsonRpcDispatcher:
         """
         if not method:
             raise ValueError("Method must be given a value")
-        callback_id = self._callback_id
-        self._callback_id += 1
-        self._callbacks[callback_id] = asyncio.Future()
+        future: Future = asyncio.get_running_loop().create_future()
+        if self._free_callback_ids:
+            callback_id = self._free_callback_ids.pop()
+            self._callbacks[callback_id] = future
+        else:
+            callback_id = len(self._callbacks)
+            self._callbacks.append(future)
         payload = {
             "jsonrpc": "2.0",
             "id": callback_id,
@@ -71,10 +97,15 @@ class JsonRpcDispatcher:
         }
         await self._send(payload)
 
-        data = await self._callbacks[callback_id]
-        del self._callbacks[callback_id]
-
-        return data
+        try:
+            return await future
+        except asyncio.CancelledError:
+            # The id stays taken until the server answers, so that a late
+            # response cannot resolve a newer request that reuses the id.
+            callbacks = self._callbacks
+            if callback_id < len(callbacks) and callbacks[callback_id] is future:
+                self.queue_notification("$/cancelRequest", {"id": callback_id})
+            raise
 
     async def send_error(
         self, code: int, message: str, data: lsp.LSPAny | None
@@ -86,10 +117,10 @@ class JsonRpcDispatcher:
           message: The error message.
           data: Optional data.
         """
-        payload = {code: code, message: message}
+        error: dict[str, Any] = {"code": code, "message": message}
         if data:
-            payload["data"] = data
-        await self._send(payload)
+            error["data"] = data
+        await self._send({"jsonrpc": "2.0", "id": None, "error": error})
 
     async def send_notification(
         self, method: str, params: lsp.LSPArray | lsp.LSPObject | None = None
@@ -103,21 +134,46 @@ class JsonRpcDispatcher:
         Raises:
           ValueError: If method is empty or None.
         """
-        message: Any = {"jsonrpc": "2.0", "method": method}
-        if params is not None:
-            message["params"] = params
-        await self._send(message)
+        self.queue_notification(method, params)
+
+    def queue_notification(
+        self, method: str, params: lsp.LSPArray | lsp.LSPObject | None = None
+    ) -> None:
+        """Queue a notification to the server without waiting.
+
+        Args:
+          method: The name of the method to invoke.
+          params: The parameters used to invoke the method.
+        """
+        self._send_queue.put_nowait((method, params))
+
+    async def flush(self) -> None:
+        """Wait until all queued messages have been written."""
+        await self._send_queue.join()
 
     async def _send(self, message: dict):
-        content = json.dumps(message)
-        data = f"Content-Length: {len(content)}\r\n\r\n{content}"
-        self._writer.write(data.encode())
-        try:
-            await self._writer.drain()
-        except ConnectionResetError:
-            if self.on_close:
-                self.on_close()
-        return
+        self._send_queue.put_nowait(message)
+
+    async def _write_loop(self) -> Coroutine[None, None, None]:
+        while True:
+            messages = [await self._send_queue.get()]
+            # Let the other tasks of this loop iteration queue their messages.
+            await asyncio.sleep(0)
+            while len(messages) < MAX_BATCH_SIZE and not self._send_queue.empty():
+                messages.append(self._send_queue.get_nowait())
+
+            try:
+                self._writer.writelines(serialize_messages(messages))
+                await self._writer.drain()
+            except ConnectionError:
+                if self.on_close:
+                    self.on_close()
+            except Exception:
+                # Drop the batch but keep writing, so flush() still returns.
+                logger.exception("Failed to write messages")
+            finally:
+                for _ in messages:
+                    self._send_queue.task_done()
 
     async def _read_loop(self) -> Coroutine[None, None, None]:
         async for message in self._read_messages():
@@ -128,9 +184,19 @@ class JsonRpcDispatcher:
                 )
                 continue
             if callback_id := message.get("id"):
-                if callback_id not in self._callbacks:
+                if (
+                    "method" in message
+                    or not isinstance(callback_id, int)
+                    or not 0 < callback_id < len(self._callbacks)
+                ):
                     continue
                 future = self._callbacks[callback_id]
+                if future is None:
+                    continue
+                self._callbacks[callback_id] = None
+                self._free_callback_ids.append(callback_id)
+                if future.done():
+                    continue
                 if "result" in message:
                     future.set_result(message["result"])
                 elif "error" in message:
@@ -143,28 +209,46 @@ class JsonRpcDispatcher:
         return
 
     async def _read_messages(self) -> AsyncGenerator[Any]:
-        while not self._reader.at_eof():
-            headers = {}
-            while True:
-                line = await self._reader.readline()
-                if line == b"\r\n":
-                    break
-                name, value = line.decode("ascii").rstrip().split(":")
-                headers[name] = value.lstrip()
-            if value := headers.get("Content-Type"):
-                if "utf-8" not in value:
-                    logger.error("Unexpected Content-Type header")
-                    await self.send_error(
-                        lsp.ErrorCodes.InvalidRequest,
-                        "Unexpected Content-Type header",
-                        None,
-                    )
-                    continue
-            if value := headers.get("Content-Length"):
-                content_length = int(value)
-                message = await self._reader.readexactly(content_length)
+        buffer = bytearray()
+        start = 0
+        while True:
+            header_end = buffer.find(b"\r\n\r\n", start)
+            if header_end < 0:
+                del buffer[:start]
+                start = 0
+                if not (data := await self._reader.read(READ_SIZE)):
+                    return
+                buffer += data
+                continue
+            content_length = -1
+            content_type = b""
+            for line in buffer[start:header_end].split(b"\r\n"):
+                name, _, value = line.partition(b":")
+                name = name.strip().lower()
+                if name == b"content-length":
+                    content_length = int(value)
+                elif name == b"content-type":
+                    content_type = value.lower()
+            start = header_end + 4
+            if content_type and b"utf-8" not in content_type:
+                logger.error("Unexpected Content-Type header")
+                await self.send_error(
+                    lsp.ErrorCodes.InvalidRequest,
+                    "Unexpected Content-Type header",
+                    None,
+                )
+                continue
+            if content_length >= 0:
+                end = start + content_length
+                while len(buffer) < end:
+                    data = await self._reader.read(max(READ_SIZE, end - len(buffer)))
+                    if not data:
+                        return
+                    buffer += data
+                content = buffer[start:end]
+                start = end
                 try:
-                    message = json.loads(message)
+                    message = json_loads(content)
                 except json.decoder.JSONDecodeError as e:
                     await self.send_error(
                         lsp.ErrorCodes.ParseError, "Could not deserialize JSON", e.msg
@@ -176,7 +260,6 @@ class JsonRpcDispatcher:
                 await self.send_error(
                     lsp.ErrorCodes.InvalidRequest, "Missing Content-Length header", None
                 )
-        return
 
 
 class LspClient:
@@ -202,9 +285,26 @@ class LspClient:
             self._client.send_notification, lambda method, timeout: asyncio.Future()
         )
         self.requests = lsp.RequestFunctions(self._send)
-        self.work_progress: dict[str, Any] = {}
+        self.work_progress: dict[int, Any] = {}
+        self._work_done_token: int = 0
+        self._pending_changes: dict[
+            lsp.DocumentUri, list[lsp.TextDocumentContentChangeEvent]
+        ] = {}
+        self._send_changes_handle: asyncio.TimerHandle | None = None
         asyncio.create_task(self._client.start())
 
+    @property
+    def text_document_sync_kind(self) -> lsp.TextDocumentSyncKind:
+        """The way the LSP server wants document changes to be synced."""
+        if self.server_capabilities is None:
+            return lsp.TextDocumentSyncKind.None_
+        sync = self.server_capabilities.get(
+            "textDocumentSync", lsp.TextDocumentSyncKind.None_
+        )
+        if isinstance(sync, Mapping):
+            return sync.get("change", lsp.TextDocumentSyncKind.None_)
+        return sync
+
     def set_notification_handler(
         self, callback: Callable[[str, Any], None] | None
     ) -> None:
@@ -251,6 +351,7 @@ class LspClient:
         if uri not in self._documents:
             raise ValueError("URI does not exist")
         del self._documents[uri]
+        self._pending_changes.pop(uri, None)
         params: lsp.DidCloseTextDocumentParams = {"textDocument": {"uri": uri}}
         await self.notifications.did_close_text_document(params)
 
@@ -267,18 +368,28 @@ class LspClient:
         if uri not in self._documents:
             raise ValueError("URI does not exist")
         document = self._documents[uri]
+        if text == document["text"]:
+            return
         content_changes: list[lsp.TextDocumentContentChangeEvent] = []
         assert self.server_capabilities is not None
 
-        match self.server_capabilities["textDocumentSync"]:
+        match self.text_document_sync_kind:
             case lsp.TextDocumentSyncKind.None_:
                 pass
             case lsp.TextDocumentSyncKind.Full:
                 content_changes.append({"text": text})
+            case lsp.TextDocumentSyncKind.Incremental if document["text"] is None:
+                content_changes.append({"text": text})
             case lsp.TextDocumentSyncKind.Incremental:
-                # content_changes = get_string_differences(document["text"], text)
-                content_changes = get_lazy_cheat_diff(document["text"], text)
+                content_changes = get_incremental_diff(
+                    document["text"],
+                    text,
+                    self.server_capabilities.get(
+                        "positionEncoding", lsp.PositionEncodingKind.UTF16
+                    ),
+                )
 
+        document["text"] = text
         document["version"] += 1
         self._documents[uri] = document
         params: lsp.DidChangeTextDocumentParams = {
@@ -288,62 +399,236 @@ class LspClient:
 
         await self.notifications.did_change_text_document(params)
 
+    def change_document(
+        self, uri: lsp.DocumentUri, change: lsp.TextDocumentContentChangeEvent
+    ) -> None:
+        """Queue an incremental change to a document.
+
+        Queued changes are sent together shortly after the first one, or
+        before the next request, whichever comes first.
+
+        Args:
+          uri: The document URI.
+          change: The change, with the range in the negotiated position encoding.
+
+        Raises:
+          ValueError: If the document is not open.
+        """
+        if uri not in self._documents:
+            raise ValueError("URI does not exist")
+        self._pending_changes.setdefault(uri, []).append(change)
+        if self._send_changes_handle is None:
+            self._send_changes_handle = asyncio.get_running_loop().call_later(
+                CHANGE_DELAY, self._send_changes
+            )
+
+    def _send_changes(self) -> None:
+        if self._send_changes_handle is not None:
+            self._send_changes_handle.cancel()
+            self._send_changes_handle = None
+        for uri, content_changes in self._pending_changes.items():
+            document = self._documents[uri]
+            # The text is no longer known, so a later update sends it all.
+            document["text"] = None
+            document["version"] += 1
+            params: lsp.DidChangeTextDocumentParams = {
+                "textDocument": {"uri": uri, "version": document["version"]},
+                "contentChanges": content_changes,
+            }
+            self._client.queue_notification("textDocument/didChange", params)
+        self._pending_changes.clear()
+
     async def exit(self) -> None:
         """Tell the LSP server to exit."""
         if self._client._writer:
-            await self.notifications.exit()
-            self._client.stop()
+            if self._send_changes_handle is not None:
+                self._send_changes_handle.cancel()
+                self._send_changes_handle = None
+            try:
+                await self.notifications.exit()
+                # Do not keep the application alive for a server that stopped
+                # reading its input.
+                await asyncio.wait_for(self._client.flush(), EXIT_TIMEOUT)
+            except TimeoutError:
+                logger.warning("Timed out sending exit to the LSP server")
+            finally:
+                self._client.stop()
 
     async def _send(
         self, method: str, params: lsp.LSPArray | lsp.LSPObject | None
     ) -> Any:
-        work_done_token = str(uuid.uuid4())
+        # The request may refer to positions in the changed text.
+        if self._pending_changes:
+            self._send_changes()
+        self._work_done_token += 1
+        work_done_token = self._work_done_token
         self.work_progress[work_done_token] = None
         if isinstance(params, Mapping):
             params["workDoneToken"] = work_done_token  # type: ignore
-        result = await self._client.send(method, params)
-        del self.work_progress[work_done_token]
-        return result
+        try:
+            return await self._client.send(method, params)
+        finally:
+            self.work_progress.pop(work_done_token, None)
+
+
+def serialize_messages(messages: list[dict | tuple[str, Any]]) -> list[bytes]:
+    """Encode messages as framed JSON-RPC content.
+
+    Args:
+      messages: The messages to encode. Notifications are (method, params)
+        tuples, other messages are dicts.
 
+    Returns:
+      The buffers to write, in order.
+    """
+    buffers = []
+    for message in coalesce_messages(messages):
+        if isinstance(message, dict):
+            content = json_dumps(message)
+            buffers.append(b"Content-Length: %d\r\n\r\n" % len(content))
+            buffers.append(content)
+            continue
+        method, params = message
+        if params is None:
+            content = NOTIFICATION_WITHOUT_PARAMS % method.encode()
+            buffers.append(b"Content-Length: %d\r\n\r\n" % len(content))
+            buffers.append(content)
+            continue
+        prefix = NOTIFICATION_PREFIX % method.encode()
+        content = json_dumps(params)
+        length = len(prefix) + len(content) + 1
+        buffers.append(b"Content-Length: %d\r\n\r\n" % length)
+        buffers.extend((prefix, content, b"}"))
+    return buffers
+
+
+def coalesce_messages(
+    messages: list[dict | tuple[str, Any]],
+) -> list[dict | tuple[str, Any]]:
+    """Merge consecutive didChange notifications for the same document.
 
-def get_lazy_cheat_diff(
-    string_old: str, string_new: str
+    Args:
+      messages: The messages in the order they were sent. Notifications are
+        (method, params) tuples, other messages are dicts.
+
+    Returns:
+      The messages to write.
+    """
+    result: list[dict | tuple[str, Any]] = []
+    for message in messages:
+        if (
+            result
+            and isinstance(message, tuple)
+            and message[0] == "textDocument/didChange"
+            and isinstance(previous := result[-1], tuple)
+            and previous[0] == "textDocument/didChange"
+            and previous[1]["textDocument"]["uri"] == message[1]["textDocument"]["uri"]
+        ):
+            params = message[1]
+            content_changes = previous[1]["contentChanges"]
+            for change in params["contentChanges"]:
+                if "range" not in change:
+                    content_changes = []
+                content_changes = [*content_changes, change]
+            result[-1] = (message[0], {**params, "contentChanges": content_changes})
+            continue
+        result.append(message)
+    return result
+
+
+def get_incremental_diff(
+    string_old: str,
+    string_new: str,
+    encoding: str = lsp.PositionEncodingKind.UTF16,
 ) -> list[lsp.TextDocumentContentChangeEvent]:
-    """The lazy way of doing it.
+    """Get the changes that turn one string into another.
+
+    The common prefix and suffix of both strings are skipped, and the text in
+    between is described as a single change. If that change covers most of the
+    new text, the whole text is sent instead.
+
+    Args:
+      string_old: The old text.
+      string_new: The new text.
+      encoding: The position encoding negotiated with the LSP server.
+
+    Returns:
+      The content changes.
+    """
+    if string_old == string_new:
+        return []
+
+    prefix = get_common_prefix_length(string_old, string_new)
+    suffix = get_common_suffix_length(
+        string_old, string_new, min(len(string_old), len(string_new)) - prefix
+    )
+    old_end = len(string_old) - suffix
+    new_end = len(string_new) - suffix
+    if 2 * (new_end - prefix) > len(string_new):
+        return [{"text": string_new}]
+
+    return [
+        {
+            "range": {
+                "start": get_position(string_old, prefix, encoding),
+                "end": get_position(string_old, old_end, encoding),
+            },
+            "text": string_new[prefix:new_end],
+        }
+    ]
 
-    TODO: Write a real implementation using difflib without cheating.
+
+def get_common_prefix_length(a: str, b: str) -> int:
+    """Get the length of the common prefix of two strings."""
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a.startswith(b[low:mid], low):
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
+def get_common_suffix_length(a: str, b: str, limit: int) -> int:
+    """Get the length of the common suffix of two strings.
+
+    Args:
+      a: The first string.
+      b: The second string.
+      limit: The maximum length to return.
     """
-    differences: list[lsp.TextDocumentContentChangeEvent] = []
-
-    if string_old != "":
-        lines = string_old.splitlines()
-        end_line = len(lines)
-        end_char = len(lines[-1]) if lines else 0
-        differences.append(
-            {
-                "range": {
-                    "start": {"line": 0, "character": 0},
-                    "end": {"line": end_line, "character": end_char},
-                },
-                "text": "",
-            }
-        )
+    low, high = 0, limit
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a.endswith(b[len(b) - mid : len(b) - low], 0, len(a) - low):
+            low = mid
+        else:
+            high = mid - 1
+    return low
 
-    if string_new != "":
-        lines = string_new.splitlines()
-        end_line = len(lines)
-        end_char = len(lines[-1]) if lines else 0
-        differences.append(
-            {
-                "range": {
-                    "start": {"line": 0, "character": 0},
-                    "end": {"line": end_line, "character": end_char},
-                },
-                "text": string_new,
-            }
-        )
 
-    return differences
+def get_position(text: str, offset: int, encoding: str) -> lsp.Position:
+    """Get the LSP position of a string offset.
+
+    Args:
+      text: The text.
+      offset: The offset into the text.
+      encoding: The position encoding.
+
+    Returns:
+      The position.
+    """
+    line = text.count("\n", 0, offset)
+    line_text = text[text.rfind("\n", 0, offset) + 1 : offset]
+    match encoding:
+        case lsp.PositionEncodingKind.UTF8:
+            character = len(line_text.encode("utf-8"))
+        case lsp.PositionEncodingKind.UTF32:
+            character = len(line_text)
+        case _:
+            character = len(line_text.encode("utf-16-le")) // 2
+    return {"line": line, "character": character}
 
 
 async def start_lsp_process(program, args: list[str]) -> Process:
@@ -356,19 +641,25 @@ async def start_lsp_process(program, args: list[str]) -> Process:
     Returns:
       The LSP process.
     """
+    debug = logger.isEnabledFor(logging.DEBUG)
     process = await asyncio.create_subprocess_exec(
         program,
         *args,
         stdin=asyncio.subprocess.PIPE,
         stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE if debug else asyncio.subprocess.DEVNULL,
     )
 
     async def log_stderr(reader):
-        while not reader.at_eof():
-            line = await reader.readline()
-            logger.debug(line)
-
-    asyncio.create_task(log_stderr(process.stderr))
+        pending = b""
+        while data := await reader.read(READ_SIZE):
+            *lines, pending = (pending + data).split(b"\n")
+            for line in lines:
+                logger.debug(line)
+        if pending:
+            logger.debug(pending)
+
+    if debug:
+        asyncio.create_task(log_stderr(process.stderr))
 
     return process
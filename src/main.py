@@ -2,13 +2,12 @@ import asyncio
 
 # import logging
 import os
-import shutil
 import sys
 import gi
 
 from gettext import gettext as _
 from gi.events import GLibEventLoopPolicy  # pyrefly: ignore[import-error]
-from .helpers import get_debug_info
+from .helpers import find_programs, get_debug_info, get_settings
 from .preferences import PreferencesDialog
 from .window import PyroseWindow
 
@@ -21,8 +20,6 @@ from gi.repository import Adw, Gdk, Gio, Gtk  # noqa: E402
 class PyroseApplication(Adw.Application):
     """The main application singleton class."""
 
-    settings = Gio.Settings.new("io.github.vanillajonathan.pyrose")
-
     def __init__(self, version):
         super().__init__(
             application_id="io.github.vanillajonathan.pyrose",
@@ -30,7 +27,6 @@ class PyroseApplication(Adw.Application):
             resource_base_path="/io/github/vanillajonathan/pyrose",
             version=version,
         )
-        asyncio.set_event_loop_policy(GLibEventLoopPolicy())
 
         self.create_action("quit", lambda *_: self.quit(), ["<primary>q"])
         self.create_action("about", self.on_about_action)
@@ -56,10 +52,15 @@ class PyroseApplication(Adw.Application):
         self.set_accels_for_action("terminal.show-search", ["<Ctrl><Shift>F"])
 
         user_home_dir = os.path.expanduser("~")
-        new_directories = f"{user_home_dir}/.cargo/bin"
-        new_directories += f":{user_home_dir}/.local/bin"
-        os.environ["PATH"] = new_directories + ":" + os.environ["PATH"]
-
+        directories = [
+            os.path.join(user_home_dir, ".cargo/bin"),
+            os.path.join(user_home_dir, ".local/bin"),
+            *os.environ.get("PATH", "").split(os.pathsep),
+        ]
+        os.environ["PATH"] = os.pathsep.join(dict.fromkeys(filter(None, directories)))
+
+        self.settings = get_settings()
+        self.settings.connect("changed::python-path", self.on_python_path_changed)
         if python_path := self.settings.get_string("python-path"):
             os.environ["PYTHONPATH"] = python_path
 
@@ -67,14 +68,35 @@ class PyroseApplication(Adw.Application):
         self.languages.append(
             ("Python", "python3", ".py", sys.executable, ["-B", "-c"])
         )
-        if shutil.which("perl"):
+        programs = find_programs("perl", "gjs", "ruby", "pyrefly")
+        if programs["perl"]:
             self.languages.append(("Perl", "perl", ".pl", "perl", ["-W"]))
-        if shutil.which("gjs"):
+        if programs["gjs"]:
             self.languages.append(("JavaScript (GJS)", "js", ".js", "gjs", ["-c"]))
-        if shutil.which("ruby"):
+        if programs["ruby"]:
             self.languages.append(("Ruby", "ruby", ".rb", "ruby", ["-e"]))
 
-        self.pyrefly_installed = bool(shutil.which("pyrefly"))
+        self.pyrefly_installed = bool(programs["pyrefly"])
+        self.pyrefly_version: str | None = None
+
+    def do_startup(self):
+        """Called when the application is started."""
+        Adw.Application.do_startup(self)
+        if self.pyrefly_installed:
+            self.create_asyncio_task(self._probe_pyrefly_version())
+
+    async def _probe_pyrefly_version(self) -> None:
+        try:
+            process = await asyncio.create_subprocess_exec(
+                "pyrefly",
+                "--version",
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+        except OSError:
+            return
+        stdout, _ = await process.communicate()
+        self.pyrefly_version = stdout.decode()
 
     def do_activate(self):
         """Called when the application is activated.
@@ -95,7 +117,9 @@ class PyroseApplication(Adw.Application):
             developer_name="Jonathan",
             developers=["Jonathan"],
             copyright="© 2025 Jonathan",
-            debug_info=get_debug_info(self.props.version, self.settings),
+            debug_info=get_debug_info(
+                self.props.version, self.settings, self.pyrefly_version
+            ),
             issue_url="https://github.com/vanillajonathan/pyrose/issues",
             license_type=Gtk.License.MIT_X11,
             version=f"{self.props.version}",
@@ -128,6 +152,13 @@ class PyroseApplication(Adw.Application):
         dialog = PreferencesDialog()
         dialog.present(self.props.active_window)
 
+    def on_python_path_changed(self, settings: Gio.Settings, key: str) -> None:
+        """Callback for changes to the python-path setting."""
+        if python_path := settings.get_string(key):
+            os.environ["PYTHONPATH"] = python_path
+        else:
+            os.environ.pop("PYTHONPATH", None)
+
     def create_action(self, name, callback, shortcuts=None):
         """Add an application action.
 
@@ -147,5 +178,6 @@ class PyroseApplication(Adw.Application):
 def main(version):
     """The application's entry point."""
     # logging.basicConfig(level=logging.DEBUG)
+    asyncio.set_event_loop_policy(GLibEventLoopPolicy())
     app = PyroseApplication(version=version)
     return app.run(sys.argv)
@@ -1,3 +1,6 @@
+HEADING_SIZES = ("", "xx-large", "x-large", "large")
+
+
 def markdown_to_pango(markdown: str) -> str:
     """Convert Markdown to Pango.
 
@@ -7,38 +10,36 @@ def markdown_to_pango(markdown: str) -> str:
     Returns:
       A string in Pango markup format.
     """
-    lines = markdown.splitlines(keepends=True)
-    pango = ""
-    code_block = ""
+    parts: list[str] = []
+    code_block: list[str] = []
     in_code_block = False
 
-    for line in lines:
+    for line in markdown.splitlines(keepends=True):
         if line.startswith("```"):
             language = line[3:]
             line = ""
             in_code_block = not in_code_block
 
         if in_code_block:
-            code_block += line
+            if line:
+                code_block.append(line)
             continue
         else:
             if code_block:
-                pango += f"<tt>{syntax_highlight(language, code_block)}</tt>"
-                code_block = ""
+                code = syntax_highlight(language, "".join(code_block))
+                parts.append(f"<tt>{code}</tt>")
+                code_block = []
                 language = None
 
-        if line.startswith("###"):
-            line = f"<span size='large'>{line.lstrip('# ')}</span>"
-        elif line.startswith("##"):
-            line = f"<span size='x-large'>{line.lstrip('# ')}</span>"
-        elif line.startswith("#"):
-            line = f"<span size='xx-large'>{line.lstrip('# ')}</span>"
+        if level := len(line) - len(line.lstrip("#")):
+            size = HEADING_SIZES[min(level, 3)]
+            line = f"<span size='{size}'>{line.lstrip('# ')}</span>"
         elif line.startswith("- "):
             line = "•" + line[1:]
 
-        pango += line
+        parts.append(line)
 
-    return pango
+    return "".join(parts)
 
 
 def syntax_highlight(language: str, code: str) -> str:
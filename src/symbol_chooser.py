@@ -19,8 +19,13 @@ class SymbolChooser(Gtk.Popover):
 
     def __init__(self):
         super().__init__()
-        for symbol in symbols:
-            label = Gtk.Label(label=symbol["symbol"], tooltip_text=symbol["desc"])
+        self.connect("map", self.on_map)
+
+    def on_map(self, widget: Gtk.Widget) -> None:
+        # Only create the labels once the popover is first shown.
+        self.disconnect_by_func(self.on_map)
+        for symbol, description in SYMBOLS:
+            label = Gtk.Label(label=symbol, tooltip_text=description)
             self.symbols.append(label)
 
     @Gtk.Template.Callback()
@@ -34,37 +39,37 @@ class SymbolChooser(Gtk.Popover):
         pass
 
 
-symbols = [
-    {"symbol": "–", "desc": "En dash (range of values)"},
-    {"symbol": "—", "desc": "Em dash (interruption in speech)"},
-    {"symbol": "°", "desc": "Degrees"},
-    {"symbol": "∑", "desc": "Summation"},
-    {"symbol": "≈", "desc": "Approximation"},
-    {"symbol": "≠", "desc": "Inequation (not equal)"},
-    {"symbol": "≤", "desc": "Less than"},
-    {"symbol": "≥", "desc": "Greater than"},
-    {"symbol": "±", "desc": "Plus-or-minus"},
-    {"symbol": "−", "desc": "Minus"},
-    {"symbol": "×", "desc": "Multiplication"},
-    {"symbol": "÷", "desc": "Division"},
-    {"symbol": "·", "desc": "Interpunct"},
-    {"symbol": "∞", "desc": "Infinite"},
-    {"symbol": "π", "desc": "Pi"},
-    {"symbol": "≔", "desc": "Assignment"},
+SYMBOLS: tuple[tuple[str, str], ...] = (
+    ("–", "En dash (range of values)"),
+    ("—", "Em dash (interruption in speech)"),
+    ("°", "Degrees"),
+    ("∑", "Summation"),
+    ("≈", "Approximation"),
+    ("≠", "Inequation (not equal)"),
+    ("≤", "Less than"),
+    ("≥", "Greater than"),
+    ("±", "Plus-or-minus"),
+    ("−", "Minus"),
+    ("×", "Multiplication"),
+    ("÷", "Division"),
+    ("·", "Interpunct"),
+    ("∞", "Infinite"),
+    ("π", "Pi"),
+    ("≔", "Assignment"),
     # Arrows
-    {"symbol": "←", "desc": "Left arrow"},
-    {"symbol": "→", "desc": "Right arrow"},
-    {"symbol": "↑", "desc": "Up arrow"},
-    {"symbol": "↓", "desc": "Down arrow"},
-    {"symbol": "↔", "desc": "Left–right arrow"},
-    {"symbol": "↕", "desc": "Up–down arrow"},
+    ("←", "Left arrow"),
+    ("→", "Right arrow"),
+    ("↑", "Up arrow"),
+    ("↓", "Down arrow"),
+    ("↔", "Left–right arrow"),
+    ("↕", "Up–down arrow"),
     # Logical operators
-    {"symbol": "∧", "desc": "Logical and"},
-    {"symbol": "∨", "desc": "Logical or"},
-    {"symbol": "¬", "desc": "Logical not"},
+    ("∧", "Logical and"),
+    ("∨", "Logical or"),
+    ("¬", "Logical not"),
     # Set theory
-    {"symbol": "∈", "desc": "Element of"},
-    {"symbol": "⊆", "desc": "Subset of"},
-    {"symbol": "∪", "desc": "Union"},
-    {"symbol": "∩", "desc": "Intersection"},
-]
+    ("∈", "Element of"),
+    ("⊆", "Subset of"),
+    ("∪", "Union"),
+    ("∩", "Intersection"),
+)
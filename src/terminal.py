@@ -1,15 +1,22 @@
 import asyncio
 import os
-import re
 import signal
 import gi
 
 from asyncio import Task
+from collections import OrderedDict
 
 gi.require_version("Gtk", "4.0")
 gi.require_version("Vte", "3.91")
 from gi.repository import Gio, GLib, Gtk, GObject, Vte  # noqa: E402
 
+PCRE2_CASELESS = 0x00000008
+PCRE2_MULTILINE = 0x00000400
+PCRE2_SEARCH_FLAGS = PCRE2_CASELESS | PCRE2_MULTILINE
+PCRE2_ESCAPE_TABLE = str.maketrans({c: "\\" + c for c in "\\^$.|?*+()[]{}"})
+PCRE2_JIT_COMPLETE = 0x00000001
+REGEX_CACHE_SIZE = 32
+
 
 @Gtk.Template(resource_path="/io/github/vanillajonathan/pyrose/terminal.ui")
 class Terminal(Gtk.Widget):
@@ -24,7 +31,12 @@ class Terminal(Gtk.Widget):
         super().__init__()
         GObject.type_ensure(Vte.Terminal)
         self.animate_fade_task: Task | None = None
+        self.search_task: Task | None = None
         self.pid: int | None = None
+        self._spawn_cancellable: Gio.Cancellable | None = None
+        self._cwd = os.environ.get("XDG_DATA_HOME", ".pyrose")
+        self._regex_cache: OrderedDict[tuple[str, int], Vte.Regex] = OrderedDict()
+        self._last_pattern: str | None = None
 
         actions = (
             ("show-search", self.show_search),
@@ -70,15 +82,16 @@ class Terminal(Gtk.Widget):
 
     @Gtk.Template.Callback()
     def on_child_exited(self, terminal, exit_status: int) -> None:
+        self.pid = None
         bullet = "🟢" if exit_status == 0 else "🔴"
         self.status_label.set_label(
             f"{bullet} Process exited with status: {exit_status}"
         )
 
         async def animate_fade():
-            self.status_label.get_style_context().add_class("visible")
+            self.status_label.add_css_class("visible")
             await asyncio.sleep(2)
-            self.status_label.get_style_context().remove_class("visible")
+            self.status_label.remove_css_class("visible")
 
         if self.animate_fade_task is not None:
             self.animate_fade_task.cancel()
@@ -87,12 +100,17 @@ class Terminal(Gtk.Widget):
 
     @Gtk.Template.Callback()
     def on_search_changed(self, entry: Gtk.SearchEntry):
-        pattern = entry.get_text()
-        text = re.escape(pattern)
-        PCRE2_CASELESS = 0x00000008
-        PCRE2_MULTILINE = 0x00000400
-        regex = Vte.Regex.new_for_search(
-            text, len(text), PCRE2_MULTILINE | PCRE2_CASELESS
+        if self.search_task is not None:
+            self.search_task.cancel()
+        self.search_task = asyncio.create_task(self._search(entry.get_text()))
+
+    async def _search(self, pattern: str, delay: float = 0.12) -> None:
+        await asyncio.sleep(delay)
+        if pattern == self._last_pattern:
+            return
+        self._last_pattern = pattern
+        regex = self._get_regex(
+            pattern.translate(PCRE2_ESCAPE_TABLE), PCRE2_SEARCH_FLAGS
         )
         self.terminal.unselect_all()
         self.terminal.search_set_regex(regex, 0)
@@ -108,13 +126,44 @@ class Terminal(Gtk.Widget):
         self.search_entry.grab_focus()
 
     def hide_search(self, action, parameter):
+        # A pending search would otherwise run after the bar is hidden.
+        if self.search_task is not None:
+            self.search_task.cancel()
+            self.search_task = None
         self.search_revealer.set_reveal_child(False)
         self.terminal.unselect_all()
+        self._last_pattern = None
+
+    def _get_regex(self, text: str, flags: int) -> Vte.Regex:
+        """Get a compiled search regex, reusing recently used ones.
+
+        Args:
+          text: The regex pattern.
+          flags: The PCRE2 compile flags.
+
+        Returns:
+          The compiled regex.
+        """
+        key = (text, flags)
+        if regex := self._regex_cache.get(key):
+            self._regex_cache.move_to_end(key)
+            return regex
+        # The length is in bytes, so let Vte find the end of the string.
+        regex = Vte.Regex.new_for_search(text, -1, flags)
+        try:
+            regex.jit(PCRE2_JIT_COMPLETE)
+        except GLib.Error:
+            pass  # Fall back to the interpreter if JIT is not available.
+        self._regex_cache[key] = regex
+        if len(self._regex_cache) > REGEX_CACHE_SIZE:
+            self._regex_cache.popitem(last=False)
+        return regex
 
     async def spawn(self, program: str, args: list[str], code: str) -> int:
         """Spawn a process."""
 
         def spawn_callback(terminal, pid: int, error: GLib.GError):
+            self._spawn_cancellable = None
             if error:
                 self.terminal.feed(f"{error.message}\r\n".encode())
                 future.set_exception(RuntimeError(error))
@@ -123,9 +172,10 @@ class Terminal(Gtk.Widget):
                 future.set_result(pid)
 
         future = asyncio.Future()
+        self._spawn_cancellable = Gio.Cancellable()
         self.terminal.spawn_async(
             Vte.PtyFlags.DEFAULT,
-            os.environ.get("XDG_DATA_HOME", ".pyrose"),  # CWD for the command
+            self._cwd,  # CWD for the command
             [
                 "nice",
                 "-n",
@@ -139,7 +189,7 @@ class Terminal(Gtk.Widget):
             None,  # child_setup
             None,  # child_setup action
             -1,  # timeout
-            None,  # cancellable
+            self._spawn_cancellable,  # cancellable
             spawn_callback,  # callback for when process finishes
             (),  # user_data for callback
         )
@@ -147,6 +197,12 @@ class Terminal(Gtk.Widget):
 
     def terminate(self) -> None:
         """Terminate the running process."""
+        if self._spawn_cancellable:
+            # The process has not been started yet.
+            self._spawn_cancellable.cancel()
         if self.pid:
-            os.kill(self.pid, signal.SIGTERM)
+            try:
+                os.kill(self.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
             self.pid = None
@@ -3,7 +3,15 @@ import logging
 import os
 import gi
 
-from lsp_types import DocumentUri, MessageType
+from asyncio import Task
+from collections.abc import Callable
+from typing import Any
+from lsp_types import (
+    DocumentUri,
+    PositionEncodingKind,
+    TextDocumentContentChangeEvent,
+    TextDocumentSyncKind,
+)
 from .code_view import CodeView
 from .lsp_client import LspClient, start_lsp_process
 from .completion_provider import CompletionProvider
@@ -14,7 +22,11 @@ from .terminal import Terminal
 gi.require_version("Adw", "1")
 gi.require_version("GtkSource", "5")
 gi.require_version("Vte", "3.91")
-from gi.repository import Adw, Gdk, Gio, GObject, Gtk, GtkSource  # noqa: E402
+from gi.repository import Adw, Gdk, Gio, GLib, GObject, Gtk, GtkSource  # noqa: E402
+
+GtkSource.init()
+GObject.type_ensure(CodeView)
+GObject.type_ensure(Terminal)
 
 logger = logging.getLogger(__name__)
 
@@ -32,15 +44,32 @@ class PyroseWindow(Adw.ApplicationWindow):
     terminal: Terminal = Gtk.Template.Child()
 
     def __init__(self, languages, **kwargs):
-        GtkSource.init()
-        GObject.type_ensure(CodeView)
-        GObject.type_ensure(Terminal)
         super().__init__(**kwargs)
         self.lsp_client: LspClient | None = None
         self.completion_provider: CompletionProvider | None = None
         self.hover_provider: HoverProvider | None = None
         self.languages = languages
+        self._language_ids = {language[0]: language[1] for language in languages}
         self.code_view.languages = languages
+        self._base_dir = os.environ.get("XDG_STATE_HOME", ".pyrose")
+        self._buffer_file = os.path.join(self._base_dir, "buffer.txt")
+        self._pyproject_file = os.path.join(self._base_dir, "pyproject.toml")
+        self.uri: DocumentUri = f"file://{self._buffer_file}"
+        self.load_buffer_task: Task | None = None
+        self.highlight_task: Task | None = None
+        self._save_lock = asyncio.Lock()
+        self._buffer_changes = 0
+        self._lsp_ready = False
+        self._has_document_highlight = False
+        self._incremental_sync = False
+        self._lsp_notification_handlers: dict[str, Callable[[Any], None]] = {
+            "textDocument/publishDiagnostics": self.code_view.apply_diagnostics,
+        }
+        try:
+            with open(self._pyproject_file, "x") as f:
+                f.write("[tool.pyrefly]")
+        except FileExistsError:
+            pass
 
         if self.props.application.props.application_id.endswith(".devel"):
             self.add_css_class("devel")
@@ -74,9 +103,17 @@ class PyroseWindow(Adw.ApplicationWindow):
         banner.set_revealed(False)
         Gtk.show_uri(self, "help:pyrose/python", Gdk.CURRENT_TIME)
 
+    @Gtk.Template.Callback()
+    def on_editor_text_changed(
+        self, code_view: CodeView, change: TextDocumentContentChangeEvent
+    ):
+        if self._lsp_ready and self._incremental_sync:
+            self.lsp_client.change_document(self.uri, change)
+
     @Gtk.Template.Callback()
     def on_editor_changed(self, code_view: CodeView, buffer: GtkSource.Buffer):
-        if self.lsp_client is None:
+        self._buffer_changes += 1
+        if not self._lsp_ready or self._incremental_sync:
             return
         task = self.lsp_client.update_document(
             self.uri, self.code_view.buffer.props.text
@@ -85,23 +122,19 @@ class PyroseWindow(Adw.ApplicationWindow):
 
     @Gtk.Template.Callback()
     def on_editor_cursor_moved(self, code_view: CodeView, buffer: GtkSource.Buffer):
-        if self.lsp_client is None or self.lsp_client.server_capabilities is None:
-            return
-        if "documentHighlightProvider" not in self.lsp_client.server_capabilities:
-            return
-        if self.lsp_client.server_capabilities["documentHighlightProvider"] is False:
+        lsp_client = self.lsp_client
+        if not self._lsp_ready or not self._has_document_highlight:
             return
 
         async def highlight():
+            await asyncio.sleep(0.04)
             insert_mark = buffer.get_insert()
             cursor_iter = buffer.get_iter_at_mark(insert_mark)
-            line = cursor_iter.get_line()
-            column = cursor_iter.get_line_offset()
             try:
-                highlights = await self.lsp_client.requests.document_highlight(
+                highlights = await lsp_client.requests.document_highlight(
                     {
                         "textDocument": {"uri": self.uri},
-                        "position": {"line": line, "character": column},
+                        "position": self.code_view.get_position(cursor_iter),
                     }
                 )
             except ValueError:
@@ -109,14 +142,16 @@ class PyroseWindow(Adw.ApplicationWindow):
 
             self.code_view.highlight(highlights)
 
-        asyncio.create_task(highlight())
+        if self.highlight_task is not None:
+            self.highlight_task.cancel()
+        self.highlight_task = asyncio.create_task(highlight())
 
     @Gtk.Template.Callback()
     def on_key_pressed(self, controller, keyval, keycode, state) -> bool:
         if keyval == Gdk.KEY_Escape and state == 0:
             self.code_view.goto_line_revealer.set_reveal_child(False)
             self.code_view.activate_action("editor.search-hide")
-            self.terminal.search_revealer.set_reveal_child(False)
+            self.terminal.activate_action("terminal.search-hide")
             self.code_view.sourceview.get_completion().hide()
             self.code_view.sourceview.grab_focus()
             return True
@@ -126,8 +161,12 @@ class PyroseWindow(Adw.ApplicationWindow):
     def on_language_selection_changed(self, dropdown: Gtk.DropDown, _):
         if string_object := dropdown.get_selected_item():
             language = string_object.get_string()
-            self.save_buffer()
-            self.set_language(language)
+
+            async def change_language():
+                await self.save_buffer()
+                self.set_language(language)
+
+            self.get_application().create_asyncio_task(change_language())
 
     def on_run_activated(self, action, parameter):
         action.set_enabled(False)
@@ -144,9 +183,9 @@ class PyroseWindow(Adw.ApplicationWindow):
     @Gtk.Template.Callback()
     def on_terminal_bell(self, terminal) -> None:
         async def visual_bell():
-            self.get_style_context().add_class("bell")
+            self.add_css_class("bell")
             await asyncio.sleep(0.5)
-            self.get_style_context().remove_class("bell")
+            self.remove_css_class("bell")
 
         asyncio.create_task(visual_bell())
 
@@ -179,12 +218,6 @@ class PyroseWindow(Adw.ApplicationWindow):
         self.terminal.terminate()
 
     def set_language(self, language: str) -> None:
-        def get_language_id(language):
-            for item in self.languages:
-                if item[0] == language:
-                    return item[1]
-            return ""
-
         async def start_lsp(uri):
             try:
                 process = await start_lsp_process("pyrefly", ["lsp"])
@@ -201,22 +234,38 @@ class PyroseWindow(Adw.ApplicationWindow):
             if self.lsp_client.server_capabilities is None:
                 print("failed to connect lsp")
                 return
+            self.code_view.position_encoding = self.lsp_client.server_capabilities.get(
+                "positionEncoding", PositionEncodingKind.UTF16
+            )
+            self._has_document_highlight = self.lsp_client.server_capabilities.get(
+                "documentHighlightProvider"
+            ) not in (None, False)
             await self.lsp_client.open_document(uri, self.code_view.buffer.props.text)
+            self._incremental_sync = (
+                self.lsp_client.text_document_sync_kind
+                == TextDocumentSyncKind.Incremental
+            )
+            self._lsp_ready = True
             if "completionProvider" in self.lsp_client.server_capabilities:
-                self.completion_provider = CompletionProvider(self.lsp_client, uri)
+                self.completion_provider = CompletionProvider(
+                    self.lsp_client, uri, self.code_view.get_position
+                )
                 self.code_view.sourceview.get_completion().add_provider(
                     self.completion_provider
                 )
             if "hoverProvider" in self.lsp_client.server_capabilities:
-                self.hover_provider = HoverProvider(self.lsp_client, uri)
+                self.hover_provider = HoverProvider(
+                    self.lsp_client, uri, self.code_view.get_position
+                )
                 self.code_view.sourceview.get_hover().add_provider(self.hover_provider)
 
-        async def exit_lsp(lsp_client):
-            await lsp_client.exit()
-
         if self.lsp_client:
-            self.get_application().create_asyncio_task(exit_lsp(self.lsp_client))
+            self.get_application().create_asyncio_task(self.lsp_client.exit())
             self.lsp_client = None
+            self._lsp_ready = False
+            self._has_document_highlight = False
+            self._incremental_sync = False
+            self.code_view.position_encoding = PositionEncodingKind.UTF16
             if self.completion_provider:
                 self.code_view.sourceview.get_completion().remove_provider(
                     self.completion_provider
@@ -228,83 +277,85 @@ class PyroseWindow(Adw.ApplicationWindow):
 
         self.code_view.clear_diagnostics()
         language_manager = GtkSource.LanguageManager.get_default()
-        source_language = language_manager.get_language(get_language_id(language))
+        source_language = language_manager.get_language(
+            self._language_ids.get(language, "")
+        )
         self.code_view.buffer.set_language(source_language)
         # print(language_manager.get_language_ids())
 
-        base_dir = os.environ.get("XDG_STATE_HOME", ".pyrose")
-        buffer_file = os.path.join(base_dir, "buffer.txt")
-        uri = f"file://{buffer_file}"
-        self.uri: DocumentUri = uri
+        async def load_buffer(with_lsp: bool):
+            loop = asyncio.get_running_loop()
+            text = await loop.run_in_executor(None, self._read_buffer)
+            # A later language change has taken over.
+            if self.load_buffer_task is not asyncio.current_task():
+                return
+            # Keep text that could not be saved rather than replace it.
+            if not self.code_view.buffer.get_modified():
+                self.code_view.buffer.props.text = text
+            if not with_lsp:
+                return
 
-        pyproject_file = os.path.join(base_dir, "pyproject.toml")
-        if not os.path.exists(pyproject_file):
-            with open(pyproject_file, "w") as f:
-                f.write("[tool.pyrefly]")
+            # Start the server once the window has drawn the text. Idle
+            # sources at the default priority run after GTK's redraw.
+            drawn = loop.create_future()
 
-        if source_language and source_language.props.id == "python3":
-            self.get_application().create_asyncio_task(start_lsp(self.uri))
+            def on_idle():
+                if not drawn.done():
+                    drawn.set_result(None)
+                return GLib.SOURCE_REMOVE
 
-        if not os.path.exists(buffer_file):
-            with open(buffer_file, "w") as f:
-                f.write("")
+            GLib.idle_add(on_idle)
+            await drawn
+            if self.load_buffer_task is asyncio.current_task():
+                await start_lsp(self.uri)
 
-        with open(buffer_file) as f:
-            self.code_view.buffer.props.text = f.read()
+        is_python = bool(source_language and source_language.props.id == "python3")
+        self.load_buffer_task = self.get_application().create_asyncio_task(
+            load_buffer(is_python)
+        )
 
     def on_lsp_notification(self, method: str, params) -> None:
-        match method:
-            case "$/cancelRequest":
-                # id
-                pass
-            case "$/logTrace":
-                # message, verbose?
-                pass
-            case "textDocument/publishDiagnostics":
-                self.code_view.apply_diagnostics(params)
-                return
-            case "$/progress":
-                # token, value
-                pass
-            case "telemetry/event":
-                pass
-            case "window/showMessage":
-                match params["type"]:
-                    case MessageType.Error:
-                        pass
-                    case MessageType.Warning:
-                        pass
-                    case MessageType.Info:
-                        pass
-                    case MessageType.Log:
-                        pass
-                    case MessageType.Debug:
-                        pass
-                pass
-            case "window/logMessage":
-                match params["type"]:
-                    case MessageType.Error:
-                        pass
-                    case MessageType.Warning:
-                        pass
-                    case MessageType.Info:
-                        pass
-                    case MessageType.Log:
-                        pass
-                    case MessageType.Debug:
-                        pass
-                pass
-        print("on_lsp_notification:", method, params)
+        if handler := self._lsp_notification_handlers.get(method):
+            handler(params)
+            return
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Unhandled LSP notification: %s %r", method, params)
 
     def on_unrealize(self, window):
         if self.lsp_client:
-            asyncio.create_task(self.lsp_client.exit())
-        self.save_buffer()
-
-    def save_buffer(self):
+            self.get_application().create_asyncio_task(self.lsp_client.exit())
+        # The main loop may already be quitting, so don't wait for it here.
         if self.code_view.buffer.get_modified():
-            base_dir = os.environ.get("XDG_STATE_HOME", ".pyrose")
-            buffer_file = os.path.join(base_dir, "buffer.txt")
-            with open(buffer_file, "w") as f:
-                f.write(self.code_view.buffer.props.text)
-            self.code_view.buffer.set_modified(False)
+            self._write_buffer(self.code_view.buffer.props.text)
+
+    async def save_buffer(self) -> None:
+        """Write the buffer to the buffer file if it has been modified.
+
+        Saves run one at a time, so an older text never overwrites a newer one.
+        """
+        async with self._save_lock:
+            buffer = self.code_view.buffer
+            if not buffer.get_modified():
+                return
+            text = buffer.props.text
+            changes = self._buffer_changes
+            loop = asyncio.get_running_loop()
+            try:
+                await loop.run_in_executor(None, self._write_buffer, text)
+            except OSError as e:
+                logger.warning("Could not save the buffer: %s", e)
+                return
+            # Edits made while the file was being written still need saving.
+            if self._buffer_changes == changes:
+                buffer.set_modified(False)
+
+    def _read_buffer(self) -> str:
+        try:
+            with open(self._buffer_file) as f:
+                return f.read()
+        except FileNotFoundError:
+            return ""
+
+    def _write_buffer(self, text: str) -> None:
+        with open(self._buffer_file, "w") as f:
+            f.write(text)